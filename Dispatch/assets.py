@@ -0,0 +1,154 @@
+# assets.py
+
+import logging
+import os
+import threading
+
+from records import QueueItem
+from state import fingerprint
+
+info = logging.getLogger('assets').info
+debug = logging.getLogger('assets').debug
+warning = logging.getLogger('assets').warning
+
+class Asset(object):
+    """ A group of sources delivered together in stages. The sources of a stage are
+    queued once every source of the stage before it has transferred successfully, so a
+    failed transfer holds the asset where it is until the retry succeeds. Markers are
+    empty files created just before their stage is queued.
+
+    An asset that is not sealed is still arriving: members can be added to its first
+    stage, and it does not move on until it is sealed with its remaining stages. The
+    sources that have landed are kept in done, so members are never added twice and the
+    directory is only removed when nothing else is in it. """
+
+    __slots__ = ('id', 'poller', 'pending', 'stages', 'markers', 'sealed', 'stage', 'done')
+
+    def __init__(self, id, poller, pending, stages=(), markers=(), sealed=True, stage=0, done=()):
+        self.id = id
+        self.poller = poller
+        self.pending = set(pending)
+        self.stages = [list(s) for s in stages if s]
+        self.markers = set(markers)
+        self.sealed = sealed
+        self.stage = stage
+        self.done = set(done)
+
+    def to_dict(self):
+        return {'poller': self.poller, 'pending': sorted(self.pending), 'stages': self.stages,
+                'markers': sorted(self.markers), 'sealed': self.sealed, 'stage': self.stage,
+                'done': sorted(self.done)}
+
+class AssetRegistry(object):
+    """ Tracks the assets that are being delivered, by id. It is shared by the pollers,
+    which register assets, and the TransferManager, which reports completed transfers. """
+
+    # Whether moving an asset on creates its markers
+    create_markers = True
+
+    def __init__(self):
+        self.assets = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, asset_id):
+        return asset_id in self.assets
+
+    def get(self, asset_id):
+        return self.assets.get(asset_id)
+
+    def pending(self, asset_id):
+        """ Returns the sources of the asset's current stage that have not completed. """
+        with self.lock:
+            asset = self.assets.get(asset_id)
+            return list(asset.pending) if asset else []
+
+    def register(self, asset_id, poller, members, stages=(), markers=(), sealed=True):
+        """ Starts tracking an asset. members make up its first stage and are submitted by
+        the poller as usual; the later stages are queued by completed(). """
+        with self.lock:
+            if asset_id not in self.assets:
+                debug('Tracking asset %s', asset_id)
+                self.assets[asset_id] = Asset(asset_id, poller, members, stages, markers, sealed)
+            return self.assets[asset_id]
+
+    def add(self, asset_id, source):
+        """ Adds a member to the first stage of an asset that has not moved past it.
+        Returns False if the asset is no longer taking members. """
+        with self.lock:
+            asset = self.assets.get(asset_id)
+            if not asset or asset.stage or source in asset.done:
+                return False
+            asset.pending.add(source)
+            return True
+
+    def seal(self, asset_id, stages, markers=()):
+        """ Marks an arriving asset as complete and sets the stages that follow its
+        first. Returns the QueueItems to queue, if its first stage has already landed. """
+        with self.lock:
+            asset = self.assets.get(asset_id)
+            if not asset or asset.sealed:
+                return []
+            debug('Sealing asset %s', asset_id)
+            asset.stages = [list(s) for s in stages if s]
+            asset.markers = set(markers)
+            asset.sealed = True
+            if asset.pending:
+                return []
+            return self.advance(asset)[0]
+
+    def completed(self, item):
+        """ Records a successful transfer. Returns (items, asset): the QueueItems of the
+        next stage if the current one just finished, and the asset itself if it has been
+        delivered completely. """
+
+        with self.lock:
+            asset = self.assets.get(item.asset)
+            if not asset:
+                return [], None
+
+            asset.pending.discard(item.source)
+            asset.done.add(item.source)
+            if asset.pending or not asset.sealed:
+                return [], None
+            return self.advance(asset)
+
+    def advance(self, asset):
+        """ Moves a sealed asset whose current stage has landed on to its next stage. """
+        if not asset.stages:
+            info('Asset %s has been delivered', asset.id)
+            del self.assets[asset.id]
+            return [], asset
+
+        stage = asset.stages.pop(0)
+        items = []
+        for source in stage:
+            if source in asset.markers and self.create_markers:
+                try:
+                    open(source, 'a').close()
+                except IOError, e:
+                    warning('Unable to create %s: %s', source, str(e))
+                    continue
+            items.append(QueueItem(source, fingerprint(source), asset=asset.id))
+        asset.pending = set(stage)
+        asset.stage += 1
+        debug('Asset %s moving on to %s', asset.id, ', '.join(os.path.basename(s) for s in stage))
+        return items, None
+
+    def forget_poller(self, poller):
+        """ Drops the assets of a poller that has been removed. """
+        with self.lock:
+            for asset_id, asset in self.assets.items():
+                if asset.poller == poller:
+                    del self.assets[asset_id]
+
+    def to_dict(self):
+        with self.lock:
+            return dict((asset_id, asset.to_dict()) for asset_id, asset in self.assets.iteritems())
+
+    def load(self, saved, pollers):
+        """ Restores assets saved by a previous agent for the given poller names. """
+        with self.lock:
+            for asset_id, a in saved.iteritems():
+                if a['poller'] in pollers and os.path.isdir(asset_id):
+                    self.assets[asset_id] = Asset(asset_id, a['poller'], a['pending'], a['stages'], a['markers'],
+                                                  a.get('sealed', True), a.get('stage', 0), a.get('done', ()))
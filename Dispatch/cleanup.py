@@ -0,0 +1,91 @@
+# cleanup.py
+
+import logging
+import os
+import shutil
+import threading
+import time
+import Queue
+
+import metrics
+
+info = logging.getLogger('cleanup').info
+debug = logging.getLogger('cleanup').debug
+warning = logging.getLogger('cleanup').warning
+critical = logging.getLogger('cleanup').critical
+
+# Created inside each poller's path, the pollers never scan it
+TRASH_DIR = '.dispatch_trash'
+
+class CleanupManager(object):
+    """ Removes delivered sources without holding up the main loop. A source is renamed
+    into its poller's trash directory, which is atomic and takes it out of the scans at
+    once, and is then deleted by a small pool of background workers. """
+
+    def __init__(self, workers=2, retries=3):
+        self.retries = retries
+        self.queue = Queue.Queue()
+        self.counter = 0
+        for i in range(workers):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+
+    def remove(self, root, source):
+        """ Moves source into the trash under root and queues it for deletion. If it can
+        not be moved it is deleted right away, as a source left in place would be found
+        and sent again. """
+
+        trash = os.path.join(root, TRASH_DIR)
+        self.counter += 1
+        target = os.path.join(trash, '%s.%d.%d' % (os.path.basename(source), time.time(), self.counter))
+        try:
+            if not os.path.isdir(trash):
+                os.mkdir(trash)
+            os.rename(source, target)
+        except OSError, e:
+            debug('Unable to move %s to the trash (%s), removing it now' % (source, str(e)))
+            try:
+                self.delete(source)
+                metrics.incr('cleanup.removed')
+            except OSError, err:
+                critical('Error removing %s: %s' % (source, str(err)))
+                metrics.incr('cleanup.failed')
+            return
+
+        self.queue.put((target, 0))
+        metrics.incr('cleanup.queued')
+        metrics.gauge('cleanup.pending', self.queue.qsize())
+
+    def purge(self, root):
+        """ Queues anything left in the trash under root by a previous agent. """
+        trash = os.path.join(root, TRASH_DIR)
+        if os.path.isdir(trash):
+            for f in os.listdir(trash):
+                self.queue.put((os.path.join(trash, f), 0))
+                metrics.incr('cleanup.queued')
+
+    def delete(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def worker(self):
+        while True:
+            path, attempt = self.queue.get()
+            try:
+                self.delete(path)
+                metrics.incr('cleanup.removed')
+            except OSError, err:
+                if not os.path.lexists(path):
+                    metrics.incr('cleanup.removed')
+                elif attempt + 1 < self.retries:
+                    debug('Error removing %s, retrying: %s' % (path, str(err)))
+                    metrics.incr('cleanup.retried')
+                    time.sleep(2 ** attempt)
+                    self.queue.put((path, attempt + 1))
+                else:
+                    critical('Error removing %s: %s' % (path, str(err)))
+                    metrics.incr('cleanup.failed')
+            metrics.gauge('cleanup.pending', self.queue.qsize())
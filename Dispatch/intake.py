@@ -0,0 +1,185 @@
+# intake.py
+
+""" Lets producers tell the agent an item is ready instead of waiting for it to be found.
+A producer connects to the intake socket and sends a line of JSON naming the poller and
+the path, and optionally a manifest of the sizes it wrote:
+
+    {"poller": "example_poller", "path": "/data/example/asset1",
+     "manifest": {"movie.mxf": 1073741824, "ADI.XML": 2048}}
+
+The path must be one of the items the poller's layout would find, a whole asset directory
+with its markers for a directory poller. The item is queued straight away, without a poll
+or a stability check, through the same dedupe rules as the pollers. Each request gets a line of JSON back, such as
+{"ok": true, "queued": true}, or {"ok": false, "error": "..."} if it was refused. """
+
+import json
+import logging
+import os
+import select
+import socket
+
+import metrics
+from pollers import INTERNAL_DIRS
+from records import QueueItem
+from state import fingerprint
+from util import StoppableThread
+
+info = logging.getLogger('intake').info
+debug = logging.getLogger('intake').debug
+warning = logging.getLogger('intake').warning
+
+class IntakeTarget(object):
+    """ What the intake needs to know about a poller it takes items for. """
+
+    __slots__ = ('path', 'exclude', 'watermarks', 'matcher')
+
+    def __init__(self, path, exclude=None, watermarks=None, matcher=None):
+        self.path = path
+        self.exclude = exclude
+        self.watermarks = watermarks
+        self.matcher = matcher
+
+class IntakeServer(StoppableThread):
+    """ Serves the intake socket. Only pollers set with set_targets take items. """
+
+    def __init__(self, socket_path, transfer_queue, process_list):
+        super(IntakeServer, self).__init__()
+        self.setDaemon(True)
+        self.socket_path = socket_path
+        self.transfer_queue = transfer_queue
+        self.process_list = process_list
+        self.targets = {}
+        self.clients = {}
+
+    def set_targets(self, targets):
+        """ Sets the pollers taking items, an IntakeTarget by poller name. """
+        self.targets = targets
+
+    def run(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0660)
+        server.listen(5)
+        info('Intake listening on %s' % self.socket_path)
+
+        while not self.stopped():
+            readable, _, _ = select.select([server] + self.clients.keys(), [], [], 1.0)
+            for sock in readable:
+                if sock is server:
+                    conn, _ = server.accept()
+                    self.clients[conn] = ''
+                else:
+                    self.read_client(sock)
+
+        for sock in self.clients:
+            sock.close()
+        server.close()
+        os.unlink(self.socket_path)
+
+    def read_client(self, sock):
+        """ Reads from a connected producer and answers every complete request. """
+        try:
+            data = sock.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            del self.clients[sock]
+            sock.close()
+            return
+
+        buf = self.clients[sock] + data
+        while '\n' in buf:
+            line, buf = buf.split('\n', 1)
+            try:
+                reply = self.handle(json.loads(line))
+            except Exception, e:
+                metrics.incr('intake.rejected')
+                reply = {'ok': False, 'error': str(e)}
+            try:
+                sock.sendall(json.dumps(reply) + '\n')
+            except socket.error:
+                del self.clients[sock]
+                sock.close()
+                return
+        self.clients[sock] = buf
+
+    def handle(self, request):
+        op = request.get('op', 'submit')
+        if op == 'ping':
+            return {'ok': True}
+        elif op == 'submit':
+            return {'ok': True, 'queued': self.submit(request.get('poller'), request.get('path'),
+                                                      request.get('manifest'))}
+        return {'ok': False, 'error': 'Unknown request: %s' % op}
+
+    def submit(self, name, path, manifest=None):
+        """ Checks the item and queues it. Returns False if it was already queued or being
+        transferred. Raises ValueError if it can not be taken. """
+
+        target = self.targets.get(name)
+        queue = self.transfer_queue.get(name)
+        if target is None or queue is None:
+            raise ValueError('%s does not take items from the intake' % name)
+        if not path or not os.path.isabs(path):
+            raise ValueError('The path must be absolute')
+
+        # Queue it the way the poller would find it, under the poller's own path
+        path = os.path.normpath(path.encode('utf-8'))
+        relative = os.path.relpath(os.path.realpath(path), os.path.realpath(target.path))
+        if relative == os.curdir or relative.startswith(os.pardir):
+            raise ValueError('%s is not under the path of %s' % (path, name))
+        for part in relative.split(os.sep):
+            if part in INTERNAL_DIRS or (target.exclude and target.exclude.match(part)):
+                raise ValueError('%s is excluded by %s' % (path, name))
+        source = os.path.join(target.path, relative)
+        if not os.path.exists(source):
+            raise ValueError('%s does not exist' % path)
+
+        # Only what the poller itself would send, never part of an asset
+        if target.matcher:
+            match = target.matcher.match(target.path, source)
+            if not match:
+                raise ValueError('%s is not an item %s sends' % (path, name))
+            if not match[1]:
+                raise ValueError('%s is missing %s' % (path, ', '.join(sorted(target.matcher.markers))))
+        if manifest:
+            self.verify(source, manifest)
+
+        running = [p for p in self.process_list.get(name, []) if p.source == source]
+        if source in queue or running:
+            metrics.incr('intake.duplicates')
+            return False
+
+        wm = target.watermarks
+        if wm and wm.high and len(queue) + queue.waiting() >= wm.high:
+            raise ValueError('The queue for %s is full, try again later' % name)
+
+        debug('Queueing %s for %s from the intake' % (source, name))
+        added = queue.append(QueueItem(source, fingerprint(source, target.exclude)))
+        metrics.incr('intake.accepted' if added else 'intake.duplicates')
+        return added
+
+    def verify(self, source, manifest):
+        """ Checks the files have the sizes the producer wrote. Names in the manifest are
+        relative to a directory source, or the file's own name for a file. """
+
+        if not isinstance(manifest, dict):
+            raise ValueError('The manifest must map file names to sizes')
+        for name, size in manifest.iteritems():
+            name = os.path.normpath(name.encode('utf-8'))
+            if os.path.isdir(source):
+                if os.path.isabs(name) or name.startswith(os.pardir):
+                    raise ValueError('%s is not in %s' % (name, source))
+                f = os.path.join(source, name)
+            elif name == os.path.basename(source):
+                f = source
+            else:
+                raise ValueError('%s is not %s' % (name, source))
+            try:
+                actual = os.path.getsize(f)
+            except OSError:
+                raise ValueError('%s does not exist' % f)
+            if actual != size:
+                raise ValueError('%s is %d bytes, the manifest says %s' % (f, actual, size))
@@ -0,0 +1,31 @@
+# metrics.py
+
+""" Counters and gauges describing what the agent is doing. The TransferManager
+periodically logs them and writes them to the status file. """
+
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+
+def incr(name, value=1):
+    """ Adds value to the named counter. """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def gauge(name, value):
+    """ Sets the named gauge to value. """
+    with _lock:
+        _gauges[name] = value
+
+def reinit():
+    """ Replaces the lock in a forked child, another thread may have held it at the
+    fork and it would never be released. """
+    global _lock
+    _lock = threading.Lock()
+
+def snapshot():
+    """ Returns a copy of every counter and gauge. """
+    with _lock:
+        return {'counters': dict(_counters), 'gauges': dict(_gauges)}
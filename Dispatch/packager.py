@@ -0,0 +1,154 @@
+# packager.py
+
+""" Bundles a directory asset into a single uncompressed tar before it is sent, so an
+asset of many small files is transferred as one object. The tar is built in a staging
+directory inside the poller's path, so it is on the same filesystem as the asset and its
+data can be copied in the kernel with copy_file_range. Where that is not possible the
+data is copied in chunks. """
+
+import ctypes
+import errno
+import logging
+import os
+import stat
+import tarfile
+
+debug = logging.getLogger('packager').debug
+
+# Created inside each poller's path, the pollers never scan it
+STAGING_DIR = '.dispatch_staging'
+
+# How much is copied at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Raised by copy_file_range when it can not copy between the two files
+UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM)
+
+def _libc_copy_file_range():
+    """ Returns copy_file_range from the C library, which Python 2's os does not have, or
+    None if there is none. """
+    try:
+        func = ctypes.CDLL(None, use_errno=True).copy_file_range
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    func.restype = ctypes.c_ssize_t
+
+    def copy_file_range(src, dst, count):
+        copied = func(src, None, dst, None, count, 0)
+        if copied < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return copied
+    return copy_file_range
+
+copy_file_range = getattr(os, 'copy_file_range', None) or _libc_copy_file_range()
+
+def staged(root, source):
+    """ Returns where the tar of source, an asset under the poller path root, is built.
+    It sits in the staging directory where source sits in root, so with the staging
+    directory as the transfer's base it lands where the directory would have. """
+    return os.path.join(root, STAGING_DIR, os.path.relpath(source, root) + '.tar')
+
+def build(root, source, exclude=None):
+    """ Builds the tar of the directory source and returns its path. The members are
+    named from the directory itself, and names matching the exclude regex are left out.
+    The tar only appears once it is complete. """
+
+    tar_path = staged(root, source)
+    if not os.path.isdir(os.path.dirname(tar_path)):
+        os.makedirs(os.path.dirname(tar_path))
+
+    partial = tar_path + '.partial'
+    out = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        written = 0
+        base = os.path.dirname(source)
+        for path in members(source, exclude):
+            st = os.lstat(path)
+            info = tarfile.TarInfo(os.path.relpath(path, base))
+            info.mode = stat.S_IMODE(st.st_mode)
+            info.mtime = st.st_mtime
+            info.uid = st.st_uid
+            info.gid = st.st_gid
+            if stat.S_ISDIR(st.st_mode):
+                info.type = tarfile.DIRTYPE
+            elif stat.S_ISLNK(st.st_mode):
+                info.type = tarfile.SYMTYPE
+                info.linkname = os.readlink(path)
+            elif stat.S_ISREG(st.st_mode):
+                info.size = st.st_size
+            else:
+                continue
+
+            written += write(out, info.tobuf(tarfile.GNU_FORMAT))
+            if info.size:
+                src = os.open(path, os.O_RDONLY)
+                try:
+                    copy(src, out, info.size)
+                finally:
+                    os.close(src)
+                written += info.size
+                written += write(out, pad(written, tarfile.BLOCKSIZE))
+
+        # Two empty blocks end the archive, which is padded to a whole record
+        written += write(out, tarfile.NUL * 2 * tarfile.BLOCKSIZE)
+        write(out, pad(written, tarfile.RECORDSIZE))
+        os.fsync(out)
+    except:
+        os.close(out)
+        os.unlink(partial)
+        raise
+    os.close(out)
+    os.rename(partial, tar_path)
+    debug('Packaged %s as %s', source, tar_path)
+    return tar_path
+
+def members(source, exclude=None):
+    """ Yields source and everything under it, parents first and in name order. """
+    for path, dirs, files in os.walk(source):
+        if exclude:
+            dirs[:] = [d for d in dirs if not exclude.match(d)]
+            files = [f for f in files if not exclude.match(f)]
+        dirs.sort()
+        yield path
+        for f in sorted(files):
+            yield os.path.join(path, f)
+        # Symbolic links to directories are not walked, they are sent as links
+        for d in [d for d in dirs if os.path.islink(os.path.join(path, d))]:
+            dirs.remove(d)
+            yield os.path.join(path, d)
+
+def pad(length, size):
+    """ Returns the zeros that take length up to a multiple of size. """
+    return tarfile.NUL * (-length % size)
+
+def write(fd, data):
+    """ Writes all of data to fd and returns its length. """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+    return len(data)
+
+def copy(src, dst, count):
+    """ Copies count bytes from src to dst, from their current offsets. """
+    global copy_file_range
+
+    while count and copy_file_range:
+        try:
+            copied = copy_file_range(src, dst, min(count, 1 << 30))
+        except OSError, e:
+            if e.errno not in UNSUPPORTED:
+                raise
+            if e.errno == errno.ENOSYS:
+                copy_file_range = None
+            break
+        if not copied:
+            raise IOError('File shrank while it was being packaged')
+        count -= copied
+
+    while count:
+        data = os.read(src, min(count, CHUNK_SIZE))
+        if not data:
+            raise IOError('File shrank while it was being packaged')
+        count -= write(dst, data)
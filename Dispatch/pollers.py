@@ -6,61 +6,194 @@ import shutil
 import time
 import threading
 
+import Dispatch.metrics as metrics
+import Dispatch.packager as packager
+from Dispatch.cleanup import TRASH_DIR
+from Dispatch.records import QueueItem, TransferQueue
+from Dispatch.rules import Rule, compile_globs, split_list
+from Dispatch.state import fingerprint
 from Dispatch.util import StoppableThread
+from Dispatch.writers import WriterIndex
 
 info = logging.getLogger('pollers').info
 debug = logging.getLogger('pollers').debug
 warning = logging.getLogger('pollers').warning
 critical = logging.getLogger('pollers').critical
 
+# Directories the agent keeps for itself inside a poller's path
+INTERNAL_DIRS = (TRASH_DIR, packager.STAGING_DIR)
+
+# The metadata files that mark an ADI asset as complete
+ADI_MARKERS = ('ADI.XML', 'ADI.DTD')
+
+# Sent last to tell the remote end an asset has been delivered
+DELIVERY_MARKER = 'delivery.complete'
+
+class Watermarks(object):
+    """ High and low watermarks on a backlog. Work pauses when the backlog reaches high
+    and resumes once it is down to low. A high of 0 means no limit. """
+
+    __slots__ = ('high', 'low')
+
+    def __init__(self, high=0, low=None):
+        self.high = high
+        if low is None:
+            low = high // 2
+        self.low = min(low, high)
+
+    def paused(self, paused, backlog):
+        """ Returns whether work should be paused at this backlog, given whether it is
+        paused now. """
+        if not self.high:
+            return False
+        if paused:
+            return backlog > self.low
+        return backlog >= self.high
+
 class PollerManager(StoppableThread):
     """ The PollerManager creates the given pollers and then periodically calls
-    each poller's poll method. """
+    each poller's poll method. Each poller has its own cadence: it is polled every
+    poll_min secs while it keeps finding new items, and backs off exponentially up to
+    poll_max secs while it finds nothing. Pollers named in progressive deliver their
+    assets progressively, and those named in package send directories as tars.
+
+    A poller whose backlog, its queued and stabilizing items, reaches its watermarks
+    stops discovering until the backlog is drained, and so do all the pollers when
+    their combined backlog reaches the agent's watermarks.
+
+    With detect_writers, a source no local process has open for writing is taken as
+    stable without waiting to see whether it changes. """
 
-    def __init__(self, poller_settings, transfer_queue, process_list, poll_interval):
+    def __init__(self, poller_settings, transfer_queue, process_list, poll_min, poll_max, rules, assets,
+                 progressive=(), watermarks=None, agent_watermarks=None, detect_writers=False, package=()):
         super(PollerManager, self).__init__()
         self.setDaemon(True)
-        self.poll_interval = poll_interval
+        self.poll_min = poll_min
+        self.poll_max = max(poll_min, poll_max)
         self.poller_list = []
-        self.create_pollers(poller_settings, transfer_queue, process_list)
+        self.watermarks = agent_watermarks or Watermarks()
+        self.paused = False
+        self.busy_since = None
+        self._wake = threading.Event()
+        self.create_pollers(poller_settings, transfer_queue, process_list, rules, assets, progressive, watermarks,
+                            package)
+        PollerBase.set_writers(WriterIndex() if detect_writers else None)
 
     def run(self):
         """ Main run loop. """
         debug('Starting Poller Manager')
-        total_sleeps = self.poll_interval / 5
-        while True:
-            num_of_sleeps = 0
+        while not self.stopped():
+            # Watched by a worker's heartbeat, a poll stuck on a hung mount never ends
+            self.busy_since = time.time()
+            self._wake.clear()
+            self.throttle()
             for poller in self.poller_list:
-                poller.poll()
-#            debug('Polling complete, sleeping for %s secs...' % self.poll_interval)
-            while not self.stopped() and num_of_sleeps < total_sleeps:
-                num_of_sleeps += 1
-                time.sleep(5)
-            if self.stopped():
-                break
-
-    def create_pollers(self, poller_settings, transfer_queue, process_list):
+                if poller.next_poll <= time.time():
+                    if self.paused or poller.paused:
+                        # Check again soon, the backlog can drain quickly
+                        poller.next_poll = time.time() + self.poll_min
+                        continue
+                    poller.found = 0
+                    poller.last_poll = time.time()
+                    poller.poll()
+                    self.schedule(poller)
+
+            if self.poller_list:
+                wait = min(p.next_poll for p in self.poller_list) - time.time()
+            else:
+                wait = self.poll_max
+            self.busy_since = None
+            if wait > 0:
+                self._wake.wait(wait)
+
+    def throttle(self):
+        """ Pauses or resumes the pollers, and the agent as a whole, according to their
+        backlogs and watermarks. """
+
+        total = 0
+        for poller in self.poller_list:
+            backlog = poller.backlog()
+            total += backlog
+            paused = poller.watermarks.paused(poller.paused, backlog)
+            if paused != poller.paused:
+                poller.info('%s discovery, %d items queued or stabilizing', 'Pausing' if paused else 'Resuming', backlog)
+                poller.paused = paused
+            metrics.gauge('pollers.%s.backlog' % poller.name, backlog)
+            metrics.gauge('pollers.%s.stabilizing' % poller.name, poller.stabilizing)
+            metrics.gauge('pollers.%s.paused' % poller.name, int(poller.paused))
+
+        paused = self.watermarks.paused(self.paused, total)
+        if paused != self.paused:
+            info('%s discovery for all pollers, %d items queued or stabilizing', 'Pausing' if paused else 'Resuming', total)
+            self.paused = paused
+        metrics.gauge('pollers.backlog', total)
+        metrics.gauge('pollers.paused', int(self.paused))
+
+    def schedule(self, poller):
+        """ Sets when the poller runs next, based on whether it found anything new. """
+        if poller.found:
+            interval = self.poll_min
+        else:
+            interval = min(poller.interval * 2, self.poll_max)
+        if interval != poller.interval:
+            poller.debug('Polling every %d secs', interval)
+        poller.interval = interval
+        poller.next_poll = time.time() + interval
+        metrics.gauge('pollers.%s.interval' % poller.name, interval)
+
+    def wake(self, name=None):
+        """ Resets the cadence of the named poller, or every poller, so it is polled
+        again poll_min secs after its last poll, or right away if that has passed. Called
+        when a transfer finishes. """
+        for poller in self.poller_list:
+            if name is None or poller.name == name:
+                poller.interval = self.poll_min
+                poller.next_poll = min(poller.next_poll, poller.last_poll + self.poll_min)
+        self._wake.set()
+
+    def stop(self):
+        super(PollerManager, self).stop()
+        self._wake.set()
+
+    def create_pollers(self, poller_settings, transfer_queue, process_list, rules, assets, progressive=(), watermarks=None,
+                       package=()):
         """ Creates pollers from the given settings. Adds then to the transfer_queue
-        and the process_list. It will also add/remove pollers from them. """
+        and the process_list. It will also add/remove pollers from them. A rule from the
+        rules file replaces the poller's own layout. The poller's excludes are compiled
+        here, once per config load. watermarks holds each poller's by lower case name,
+        and the default under None. """
 
+        watermarks = watermarks or {}
         for s in poller_settings:
             if s.poller_type in globals().keys():
 #                debug("Creating poller: %s" % s.name)
                 p = globals()[s.poller_type](s.name, s.path)
+                p.set_excludes(split_list(s.excludes))
+                p.interval = self.poll_min
+                p.progressive = s.name in progressive
+                p.package = s.name in package
+                p.watermarks = watermarks.get(s.name.lower(), watermarks.get(None, Watermarks()))
+                if isinstance(p, RulePoller):
+                    if s.name in rules:
+                        p.set_rule(rules[s.name])
+                    if not p.matcher:
+                        critical("%s has no rule in the rules file.", s.name)
+                        raise Exception('%s poller has no rule' % s.name)
                 self.poller_list.append(p)
 
                 if s.name not in transfer_queue.keys():
 #                    debug('Creating %s queue'% s.name)
-                    transfer_queue[s.name] = []
+                    transfer_queue[s.name] = TransferQueue()
                     process_list[s.name] = []
 #                else:
 #                    debug('%s queue exists, skipping' % s.name)
 
             else:
-                critical("%s is not a valid poller type." % s.poller_type)                                         
+                critical("%s is not a valid poller type.", s.poller_type)                                         
                 raise Exception('%s poller does not exist' % s.poller_type)
         PollerBase.set_transfer_queue(transfer_queue)
         PollerBase.set_process_list(process_list)
+        PollerBase.set_assets(assets)
 
 class PollerBase(object):
     """ Base poller class. All pollers must inherit from this class and override the 
@@ -69,25 +202,74 @@ class PollerBase(object):
 
     transfer_queue = {}
     process_list = {}
+    assets = None
+    writers = None
+    progressive = False
+    package = False
+    watermarks = Watermarks()
+
+    # Whether producers can push items through the intake instead
+    intake = True
 
     def __init__(self, name, path):
         self.name = name
         self.path = path
+        self.excludes = []
+        self.exclude = None
+        self.interval = 0
+        self.next_poll = 0
+        self.last_poll = 0
+        self.found = 0
+        self.paused = False
+        self.stabilizing = 0
+        self.checking = set()
+        self._stabilizing_lock = threading.Lock()
         self.debug = logging.getLogger('pollers.%s' % self.name).debug
         self.info = logging.getLogger('pollers.%s' % self.name).info
         self.warning = logging.getLogger('pollers.%s' % self.name).warning
+        self.critical = logging.getLogger('pollers.%s' % self.name).critical
 
     def poll(self):
         raise Exception('You must overload this function.')
 
-    def validate_and_submit(self, filename):
+    def set_excludes(self, excludes):
+        """ Sets the globs for names this poller never scans, checks or sends. """
+        self.excludes = list(excludes)
+        self.exclude = compile_globs(self.excludes)
+
+    def excluded(self, name):
+        return name in INTERNAL_DIRS or bool(self.exclude and self.exclude.match(name))
+
+    def listdir(self, path):
+        """ Lists path, leaving out excluded names and the agent's own directories. """
+        return [f for f in os.listdir(path) if not self.excluded(f)]
+
+    def validate_and_submit(self, filename, asset=None):
         """ Check if filename is already in the queue or currently being transferred.
         If not, then it will validate that the file/directory is not actively being 
-        written too. If it passes, then it is added to the transfer_queue. """
+        written too. If it passes, then it is added to the transfer_queue. asset is the
+        id of the asset filename belongs to, if any. """
+
+        if self.paused:
+            return
+
+        # Already being checked, a slow check is not doubled up on the next poll
+        if filename in self.checking:
+            return
 
         matches = [p for p in self.process_list[self.name] if filename == p.source]
         if filename not in self.transfer_queue[self.name] and not matches:
-            t = threading.Thread(target=self.is_stable, args=(filename,))
+            # Stop taking on work mid scan once the backlog is full
+            if self.watermarks.paused(False, self.backlog()):
+                self.info('Pausing discovery, %d items queued or stabilizing', self.backlog())
+                self.paused = True
+                return
+
+            self.found += 1
+            with self._stabilizing_lock:
+                self.stabilizing += 1
+                self.checking.add(filename)
+            t = threading.Thread(target=self.check, args=(filename, asset))
             t.setDaemon(True)
             t.start()
 #        else:
@@ -101,18 +283,71 @@ class PollerBase(object):
     def set_process_list(cls, process_list):
         cls.process_list = process_list
 
-    def is_stable(self, source):
+    @classmethod
+    def set_assets(cls, assets):
+        cls.assets = assets
+
+    @classmethod
+    def set_writers(cls, writers):
+        cls.writers = writers
+
+    def backlog(self):
+        """ Returns how many of this poller's items are queued, waiting to be retried or
+        being checked for stability. """
+        queue = self.transfer_queue[self.name]
+        return len(queue) + queue.waiting() + self.stabilizing
+
+    def check(self, source, asset=None):
+        """ Runs the stability check, counting it in the backlog while it runs. """
+        try:
+            self.is_stable(source, asset)
+        finally:
+            with self._stabilizing_lock:
+                self.stabilizing -= 1
+                self.checking.discard(source)
+
+    def submit(self, source, asset=None):
+        """ Adds a stable source to the transfer_queue. Its fingerprint is saved with the
+        queue so a restarted agent can requeue it without checking it again. A packaging
+        poller sends a directory as a tar, built here. """
+
+        package = None
+        if self.package and os.path.isdir(source) and source not in self.transfer_queue[self.name]:
+            try:
+                package = packager.build(self.path, source, self.exclude)
+            except (IOError, OSError), e:
+                self.warning('Unable to package %s, sending it as it is: %s', source, e)
+
+        self.debug('Adding %s to the queue', source)
+        self.transfer_queue[self.name].append(QueueItem(source, fingerprint(source, self.exclude), asset=asset,
+                                                        package=package))
+
+    def is_stable(self, source, asset=None):
         ''' Checks that the given source is stable and that there is no file system activity. '''
 
         """ NOTE!! It only checks the contents of the given directory, it will not recursively check 
         sub directories. """
 
-        self.debug("Verifying %s is stable" % source.split('/')[-1])
+        self.debug("Verifying %s is stable", source.split('/')[-1])
 
         if not os.path.exists(source):
-            self.warning('%s does not exist.' % source)
+            self.warning('%s does not exist.', source)
             return
 
+        # No need to wait when it can be told no one is writing it
+        if self.writers:
+            if os.path.isfile(source):
+                files = [source]
+            else:
+                files = [os.path.join(source, f) for f in self.listdir(source) if os.path.isfile(os.path.join(source, f))]
+            stable = self.writers.check(source, files)
+            if stable:
+                self.submit(source, asset)
+                return
+            elif stable is False:
+                self.debug('%s is still being written', source.split('/')[-1])
+                return
+
         # If source is a file
         if os.path.isfile(source):
 #            self.debug('%s is a file' % source.split('/')[-1])
@@ -130,14 +365,13 @@ class PollerBase(object):
             if lb1 != lb2:
                 return
             else:
-                self.debug('Adding %s to the queue' % source)
-                self.transfer_queue[self.name].append(source)
+                self.submit(source, asset)
                 return 
 
         # If source is a directory
         elif os.path.isdir(source):
 #            self.debug('%s is a directory' % source.split('/')[-1])
-            file_list = [os.path.join(source, f) for f in os.listdir(source) if os.path.isfile(os.path.join(source, f))]
+            file_list = [os.path.join(source, f) for f in self.listdir(source) if os.path.isfile(os.path.join(source, f))]
 
             # If empty dir, skip
             if not file_list:
@@ -154,7 +388,7 @@ class PollerBase(object):
             time.sleep(10)
 
             # Return False if any new files were created during our sleep
-            second_file_list = [os.path.join(source, f) for f in os.listdir(source) if os.path.isfile(os.path.join(source, f))]
+            second_file_list = [os.path.join(source, f) for f in self.listdir(source) if os.path.isfile(os.path.join(source, f))]
             if file_list != second_file_list:
                 return 
 
@@ -168,192 +402,209 @@ class PollerBase(object):
                     return 
             
             # Everything passed!
-            self.debug('Adding %s to the queue' % source)
-            self.transfer_queue[self.name].append(source)
+            self.submit(source, asset)
             return 
 
         # Don't know what we got, so quit
         else:
-            self.critical('Unknown item %s...skipping.' % source)
+            self.critical('Unknown item %s...skipping.', source)
             return 
 
-class FilePoller(PollerBase):
-    """ A basic poller that scans the given path and transfers the found files. Does not support directories or
-    any type of recursion. """
+class RulePoller(PollerBase):
+    """ A poller driven entirely by a Rule describing its layout. The rule is compiled once
+    and the tree is walked in a single pass. Layouts without a class of their own can be
+    described in the rules file and use this poller type. """
 
-    def poll(self):
-        files = [f for f in os.listdir(self.path) if os.path.isfile(os.path.join(self.path, f)) and not f.startswith('.')]
-        self.debug('Checking for files...')
+    rule = None
 
-        # Check for files
-        if files:
-            for f in files:
-                self.validate_and_submit(os.path.join(self.path, f))
-        else:
-            self.debug('No files found...')
+    def __init__(self, name, path):
+        super(RulePoller, self).__init__(name, path)
+        self.matcher = None
+        self.sealing = set()
+        self.late = set()
+        self.compile()
 
-class DirPoller(PollerBase):
-    """ Poller that scans the given path and transfers the found directories. It will initate a transfer               
-    once the XML and DTD files exist. Does not support files or any recursion. """
+    def set_rule(self, rule):
+        self.rule = rule
+        self.compile()
+
+    def set_excludes(self, excludes):
+        super(RulePoller, self).set_excludes(excludes)
+        self.compile()
+
+    def compile(self):
+        if self.rule:
+            self.matcher = self.rule.compile(ignore=INTERNAL_DIRS, exclude=self.excludes)
 
     def poll(self):
-        dirs = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]                         
-        self.debug('Checking for directories...')
+        self.debug('Checking for ready items...')
+        for path, ready, files in self.matcher.scan(self.path):
+            if self.paused:
+                break
+            if self.progressive and files is not None:
+                self.deliver(path, ready, files)
+            elif ready:
+                self.validate_and_submit(path)
+            else:
+                self.debug('Asset %s not ready', os.path.basename(path))
 
-        if dirs:
-            # For each dir found, transfer if ready
-            for d in dirs:
-                path = os.path.join(self.path, d)
-                files = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))]
-                if 'ADI.DTD' in files and 'ADI.XML' in files:
-                    self.validate_and_submit(os.path.join(self.path, d))
-                else:
-                    self.debug('Asset %s not ready' % d)
-        else:
-            self.debug('No directories found...')
+    def deliver(self, path, ready, files):
+        """ Progressive delivery of a 'dir' unit. Each file is sent on its own as soon as
+        it is stable, while the rest of the asset is still arriving. Once the rule's
+        markers exist and have settled, they are sent after everything else, followed by
+        the delivery marker. Files that land once the asset has moved on are not sent,
+        and are reported. """
 
-class SubDirPoller(PollerBase):
-    """ Poller that scans the given path for subdirectories, and then transfers each file found in the subdirs
-    individually while maintaining the directory structure. This will not remove the subdirectories. """
+        if not files:
+            return
+        # Delivered, and kept because files landed too late, it is not sent again
+        if DELIVERY_MARKER in files and path not in self.assets:
+            return
+        asset = self.assets.register(path, self.name, [], sealed=False)
 
-    def poll(self):
-        dirs = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]
-        self.debug('Checking subdirectories...')
+        members = [os.path.join(path, f) for f in files if f not in self.matcher.markers and f != DELIVERY_MARKER]
+        for source in members:
+            if self.assets.add(path, source) or source in asset.done or source in self.late:
+                continue
+            self.late.add(source)
+            self.warning('%s landed after asset %s was sealed and will not be sent',
+                         os.path.basename(source), os.path.basename(path))
+
+        # Everything pending, as a member added while discovery was paused was not sent
+        pending = set(self.assets.pending(path))
+        for source in members:
+            if source in pending:
+                self.validate_and_submit(source, path)
+
+        if ready and not asset.sealed and path not in self.sealing:
+            self.sealing.add(path)
+            metadata = [os.path.join(path, f) for f in files if f in self.matcher.markers]
+            t = threading.Thread(target=self.seal, args=(path, metadata))
+            t.setDaemon(True)
+            t.start()
 
-        for d in dirs:
-            dirpath = os.path.join(self.path, d)
+    def seal(self, path, metadata):
+        """ Seals a progressive asset once none of its files, the metadata or the
+        members, has landed or changed for a while. Otherwise it is left for a later
+        poll. """
+        def snapshot():
+            return [(f, fingerprint(os.path.join(path, f))) for f in sorted(self.matcher.files(path))]
 
-            files = [f for f in os.listdir(dirpath) if os.path.isfile(os.path.join(dirpath, f))]
-            if files:
-                for f in files:
-                    filepath = os.path.join(dirpath, f)
-                    self.validate_and_submit(filepath)
-            else:
-                self.debug('No files found at %s...' % d)
+        try:
+            before = snapshot()
+            time.sleep(10)
+            if [m for m in metadata if not os.path.exists(m)] or snapshot() != before:
+                return
 
-class TelusPoller(PollerBase):
-    """ Custom Poller to support Telus. Directories are structured into provider_id/asset_id/<sd or hd>. The dirs
-    are searched and files sent retaining this structure. """
+            self.debug('Asset %s is complete', os.path.basename(path))
+            marker = os.path.join(path, DELIVERY_MARKER)
+            for item in self.assets.seal(path, [metadata, [marker]], [marker]):
+                self.transfer_queue[self.name].append(item)
+        finally:
+            self.sealing.discard(path)
 
-    def poll(self):
-        # Get all provider IDs
-        provider_ids = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]
-        if not provider_ids:
-            self.debug('No providers found.')
-            return
+class FilePoller(RulePoller):
+    """ A basic poller that scans the given path and transfers the found files. Does not support directories or
+    any type of recursion. """
 
-        # Scan each provider
-        for provider in provider_ids:
-            self.debug('Checking provider: %s' % provider)
-            provider_path = os.path.join(self.path, provider)
+    rule = Rule(unit='file', skip_hidden=True)
 
-            # Scan SD/HD
-            dirs = [d for d in os.listdir(provider_path) if os.path.isdir(os.path.join(provider_path, d))]
-            if not dirs:
-                self.debug('No subdirs found for %s' % provider)
-                continue
+class DirPoller(RulePoller):
+    """ Poller that scans the given path and transfers the found directories. It will initate a transfer
+    once the XML and DTD files exist. Does not support files or any recursion. """
 
-            # Scan for files
-            for d in dirs:
-                dirpath = os.path.join(provider_path, d)
-                files = [f for f in os.listdir(dirpath) if os.path.isfile(os.path.join(dirpath, f))]
-                if files:
-                    for f in files:
-                        filepath = os.path.join(dirpath, f)
-                        self.validate_and_submit(filepath)
-                else:
-                    self.debug('No files found at %s/%s...' % (provider, d))
-
-class PAPoller(PollerBase):
-    """ A poller to support the provider/asset directory structure. It supports the following                              
-    directory structure: /provider_id/asset_id/files. It will send the asset_id directory once
-    the ADI.XML and ADI.DTD files exist. """
+    rule = Rule(unit='dir', markers=ADI_MARKERS)
 
-    def poll(self):
-        # Get all provider IDs
-        provider_ids = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]
+class SubDirPoller(RulePoller):
+    """ Poller that scans the given path for subdirectories, and then transfers each file found in the subdirs
+    individually while maintaining the directory structure. This will not remove the subdirectories. """
 
-        # For each provider
-        for provider in provider_ids:
-            self.debug('Checking provider: %s' % provider)
-            provider_path = os.path.join(self.path, provider)
+    rule = Rule(depth=1, unit='file')
 
-            # Get all asset_ids for the given provider
-            asset_ids = [d for d in os.listdir(provider_path) if os.path.isdir(os.path.join(provider_path, d))]
+class TelusPoller(RulePoller):
+    """ Custom Poller to support Telus. Directories are structured into provider_id/asset_id/<sd or hd>. The dirs
+    are searched and files sent retaining this structure. """
 
-            # Return if no assets found
-            if not asset_ids:
-                self.debug('No assets found.')
-                continue
+    rule = Rule(depth=2, unit='file')
+
+class PAPoller(RulePoller):
+    """ A poller to support the provider/asset directory structure. It supports the following
+    directory structure: /provider_id/asset_id/files. It will send the asset_id directory once
+    the ADI.XML and ADI.DTD files exist. """
 
-            # For each asset, check for files, if files then transfer
-            for asset in asset_ids:
-                asset_path = os.path.join(provider_path, asset)
+    rule = Rule(depth=1, unit='dir', markers=ADI_MARKERS)
 
-                # Get all files for the given asset
-                files = [f for f in os.listdir(asset_path) if os.path.isfile(os.path.join(asset_path, f))]
-                self.debug('Checking asset %s...' % asset)
+class GooglePoller(RulePoller):
+    """ Google Poller. Each asset directory is tracked as an asset: its files are sent,
+    and once every one of them has transferred the delivery.complete marker is created
+    and sent straight away. The directory is removed when the marker has been delivered.
+    A failed file holds the marker back until its retry succeeds. """
 
-                # Check for ADI.XML, if found transfer it and remove the asset_id directory
-                if 'ADI.XML' in files and 'ADI.DTD' in files:
-                    self.debug('Found XML/DTD in %s' % asset)
-                    self.validate_and_submit(asset_path)
-                else:
-                    self.debug('Asset %s not ready...' % asset)
+    rule = Rule(unit='dir', markers=ADI_MARKERS, skip_hidden=True)
 
-class GooglePoller(PollerBase):
-    """ Google Poller """
+    # Its assets are tracked from the scans
+    intake = False
 
     def poll(self):
-        dirs = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]                         
         self.debug('Checking for directories...')
 
-        for d in dirs:
-            dirpath = os.path.join(self.path, d)
-
-            files = [f for f in os.listdir(dirpath) if os.path.isfile(os.path.join(dirpath, f)) and not f.startswith('.')]
+        for dirpath, ready, files in self.matcher.scan(self.path):
+            if self.paused:
+                break
+            d = os.path.basename(dirpath)
+            marker = os.path.join(dirpath, 'delivery.complete')
 
-            # If only the dispatch.done exists, remove asset dir
-            if len(files) == 1 and 'dispatch.done' in files:
-                self.debug('Found %s/dispatch.done, removing dir...' % d)
+            # Being delivered, take in late files while the marker is not due, and resubmit
+            # any file that did not pass the stability check
+            if dirpath in self.assets:
+                for f in files:
+                    if f != DELIVERY_MARKER:
+                        self.assets.add(dirpath, os.path.join(dirpath, f))
+                for source in self.assets.pending(dirpath):
+                    if os.path.basename(source) in files and source != marker:
+                        self.validate_and_submit(source, dirpath)
+
+            # Left behind by an older agent, which removed the dir on the next poll
+            elif len(files) == 1 and 'dispatch.done' in files:
+                self.debug('Found %s/dispatch.done, removing dir...', d)
                 try:
                     shutil.rmtree(dirpath)
                 except Exception, e:
-                    self.warning('Unable to remove asset dir %s' % d)
+                    self.warning('Unable to remove asset dir %s', d)
                     self.warning(str(e))
 
-            # If only the delivery.complete exists, send it and create dispatch.done
-            elif len(files) ==1 and 'delivery.complete' in files:
-                self.debug('Found %s/delivery.complete, sending...' % d)
-                self.validate_and_submit(os.path.join(dirpath, 'delivery.complete'))
-                self.debug('Creating %s/dispatch.done' % d)
-                open(os.path.join(dirpath, 'dispatch.done'), 'a').close()
+            # Only the marker is left to send
+            elif len(files) == 1 and 'delivery.complete' in files:
+                self.debug('Found %s/delivery.complete, sending...', d)
+                self.assets.register(dirpath, self.name, [marker])
+                self.validate_and_submit(marker, dirpath)
 
-            # If entire asset exists, send it and create delivery.complete
-            elif 'ADI.XML' in files and 'ADI.DTD' in files and not 'delivery.complete' in files:
-                self.debug('Found asset %s...' % d)
-                for f in files:
-                    self.validate_and_submit(os.path.join(dirpath, f))
-                self.debug('Creating %s/delivery.complete' % d)
-                open(os.path.join(dirpath, 'delivery.complete'), 'a').close()
+            # If entire asset exists, send it, the marker follows once it has all landed
+            elif ready and not 'delivery.complete' in files:
+                self.debug('Found asset %s...', d)
+                members = [os.path.join(dirpath, f) for f in files]
+                self.assets.register(dirpath, self.name, members, stages=[[marker]], markers=[marker])
+                for source in members:
+                    self.validate_and_submit(source, dirpath)
 
             else:
-                self.debug('Asset %s not ready...' % d)
+                self.debug('Asset %s not ready...', d)
 
-class DirTarPoller(PollerBase):
+class DirTarPoller(RulePoller):
     """ Poller that will search for asset subdirectories and then send the single .tar file that exists. """
 
-    def poll(self):
-        dirs = [d for d in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, d))]                         
-        self.debug('Checking for directories...')
-
-        if dirs:
-            # For each dir found, transfer if ready
-            for d in dirs:
-                path = os.path.join(self.path, d)
-                files = [f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f)) and f.endswith('.tar')]
-                if files:
-                    for f in files:
-                        self.validate_and_submit(os.path.join(path, f))
-        else:
-            self.debug('No directories found...')
+    rule = Rule(depth=1, unit='file', include=['*.tar'])
+
+def layout(poller_type, rule=None, excludes=()):
+    """ Returns the Matcher a poller of this type scans with, rule from the rules file
+    replacing the type's own, or None if it has no layout. """
+    cls = globals().get(poller_type)
+    rule = rule or getattr(cls, 'rule', None)
+    if not rule:
+        return None
+    return rule.compile(ignore=INTERNAL_DIRS, exclude=excludes)
+
+def accepts_intake(poller_type):
+    """ True if the poller type takes items pushed through the intake. """
+    cls = globals().get(poller_type)
+    return isinstance(cls, type) and issubclass(cls, PollerBase) and cls.intake
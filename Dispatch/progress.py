@@ -0,0 +1,52 @@
+# progress.py
+
+import re
+import time
+
+# ascp progress lines look like: "movie.mxf    45%  450MB  120Mb/s    00:30 ETA"
+PROGRESS_RE = re.compile(r'^\s*(\S.*?)\s+(\d+)%\s+([\d.]+)([KMGT]?)B\b')
+UNITS = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+TAIL_SIZE = 4096
+
+class Progress(object):
+    """ Follows a transfer's output. Keeps the tail of it, when it last changed, and how
+    many bytes have been sent according to the progress lines. ascp reports each file
+    separately, so a file's last figure is banked when the next file starts. """
+
+    __slots__ = ('tail', 'updated', 'done', 'current', 'current_file', 'partial')
+
+    def __init__(self):
+        self.tail = ''
+        self.updated = time.time()
+        self.done = 0
+        self.current = 0
+        self.current_file = None
+        self.partial = ''
+
+    @property
+    def bytes(self):
+        return self.done + self.current
+
+    def feed(self, data):
+        """ Takes new output and returns how many more bytes have been sent. """
+        if not data:
+            return 0
+
+        before = self.bytes
+        self.updated = time.time()
+        self.tail = (self.tail + data)[-TAIL_SIZE:]
+
+        lines = re.split(r'[\r\n]', self.partial + data)
+        self.partial = lines.pop()
+        for line in lines:
+            m = PROGRESS_RE.match(line)
+            if not m:
+                continue
+            name, size = m.group(1), int(float(m.group(3)) * UNITS[m.group(4)])
+            if name != self.current_file:
+                self.done += self.current
+                self.current_file = name
+                self.current = 0
+            self.current = max(self.current, size)
+
+        return self.bytes - before
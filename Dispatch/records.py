@@ -0,0 +1,99 @@
+# records.py
+
+import heapq
+import threading
+import time
+from collections import deque
+
+class QueueItem(object):
+    """ A source that is queued or being transferred. The same record follows the source
+    from the stability check through to the end of its transfer. size is set when the
+    transfer starts. package is the tar sent in place of a packaged directory. """
+
+    __slots__ = ('source', 'fingerprint', 'attempts', 'log_id', 'asset', 'size', 'package')
+
+    def __init__(self, source, fingerprint=None, attempts=0, log_id=None, asset=None, size=None, package=None):
+        self.source = source
+        self.fingerprint = fingerprint
+        self.attempts = attempts
+        self.log_id = log_id
+        self.asset = asset
+        self.size = size
+        self.package = package
+
+    def __repr__(self):
+        return '<QueueItem %s>' % self.source
+
+class TransferQueue(object):
+    """ A poller's queue of QueueItems. Items are indexed by source, so checking whether a
+    source is already queued does not walk the queue. Deferred items wait out of line
+    until their time comes, and only then count towards the queue's length. """
+
+    __slots__ = ('items', 'index', 'lock', 'deferred', 'counter')
+
+    def __init__(self):
+        self.items = deque()
+        self.index = set()
+        self.lock = threading.Lock()
+        self.deferred = []
+        self.counter = 0
+
+    def append(self, item):
+        """ Adds item to the end of the queue, unless its source is already queued. """
+        with self.lock:
+            if item.source in self.index:
+                return False
+            self.index.add(item.source)
+            self.items.append(item)
+            return True
+
+    def appendleft(self, item):
+        """ Adds item to the front of the queue, unless its source is already queued. """
+        with self.lock:
+            if item.source in self.index:
+                return False
+            self.index.add(item.source)
+            self.items.appendleft(item)
+            return True
+
+    def defer(self, item, until):
+        """ Queues item once the time until has passed, unless its source is already
+        queued. """
+        with self.lock:
+            if item.source in self.index:
+                return False
+            self.index.add(item.source)
+            self.counter += 1
+            heapq.heappush(self.deferred, (until, self.counter, item))
+            return True
+
+    def promote(self):
+        """ Moves the deferred items that are due to the end of the queue. Called with
+        the lock held. """
+        now = time.time()
+        while self.deferred and self.deferred[0][0] <= now:
+            self.items.append(heapq.heappop(self.deferred)[2])
+
+    def popleft(self):
+        with self.lock:
+            self.promote()
+            item = self.items.popleft()
+            self.index.discard(item.source)
+            return item
+
+    def snapshot(self):
+        """ Returns a list of the queued items, deferred ones included. """
+        with self.lock:
+            return list(self.items) + [entry[2] for entry in sorted(self.deferred)]
+
+    def waiting(self):
+        """ Returns how many items are deferred. """
+        return len(self.deferred)
+
+    def __contains__(self, source):
+        return source in self.index
+
+    def __len__(self):
+        with self.lock:
+            self.promote()
+            return len(self.items)
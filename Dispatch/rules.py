@@ -0,0 +1,172 @@
+# rules.py
+
+""" Declarative readiness rules. A poller describes the layout of its tree and what makes
+an item in it ready, and the rule is compiled into a matcher that finds every item in a
+single pass over the tree. """
+
+import fnmatch
+import os
+import re
+import stat
+
+from ConfigParser import SafeConfigParser
+
+UNITS = ('file', 'dir')
+
+def split_list(value):
+    """ Splits a comma separated setting into a list. """
+    if not value:
+        return []
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+def compile_globs(globs):
+    """ Compiles a list of globs into a single regex, or None if there are none. """
+    if not globs:
+        return None
+    return re.compile('|'.join('(?:%s)' % fnmatch.translate(g) for g in globs))
+
+class Rule(object):
+    """ Describes a poller's layout.
+
+    depth:          directory levels between the poller's path and the submission units
+    unit:           'file' submits each matching file, 'dir' submits each directory
+    markers:        files that must exist in a 'dir' unit before it is ready
+    include:        globs a file name must match, all files if empty
+    exclude:        globs for file and directory names to leave out
+    skip_hidden:    leave out names starting with a dot
+    """
+
+    def __init__(self, depth=0, unit='file', markers=(), include=(), exclude=(), skip_hidden=False):
+        if unit not in UNITS:
+            raise ValueError('Unknown unit %s, must be one of %s' % (unit, ', '.join(UNITS)))
+        self.depth = int(depth)
+        self.unit = unit
+        self.markers = list(markers)
+        self.include = list(include)
+        self.exclude = list(exclude)
+        self.skip_hidden = skip_hidden
+
+    def compile(self, ignore=(), exclude=()):
+        """ Returns a Matcher for this rule. Names in ignore are never listed, and the
+        exclude globs are added to the rule's own. """
+        return Matcher(self, ignore, exclude)
+
+class Matcher(object):
+    """ A compiled Rule. scan() walks the tree once and yields (path, ready, files) for
+    each submission unit. For 'dir' units, files are the names of the files directly
+    inside the directory; for 'file' units it is None and ready is always True. """
+
+    def __init__(self, rule, ignore=(), exclude=()):
+        self.depth = rule.depth
+        self.unit = rule.unit
+        self.markers = set(rule.markers)
+        self.skip_hidden = rule.skip_hidden
+        self.ignore = set(ignore)
+        self.include = compile_globs(rule.include)
+        self.exclude = compile_globs(rule.exclude + list(exclude))
+
+    def skipped(self, name):
+        """ True if the name is left out of the scan entirely. Excluded directories are
+        never descended into. """
+        if name in self.ignore:
+            return True
+        if self.skip_hidden and name.startswith('.'):
+            return True
+        return bool(self.exclude and self.exclude.match(name))
+
+    def wanted(self, name):
+        """ True if a file with this name belongs to a submission. """
+        return not self.skipped(name) and (not self.include or bool(self.include.match(name)))
+
+    def entries(self, path):
+        """ Yields (name, full path, stat mode) for everything listed in path. """
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        for name in names:
+            if self.skipped(name):
+                continue
+            full = os.path.join(path, name)
+            try:
+                mode = os.stat(full).st_mode
+            except OSError:
+                continue
+            yield name, full, mode
+
+    def files(self, path):
+        """ Returns the wanted files directly inside path. """
+        return [name for name, full, mode in self.entries(path) if stat.S_ISREG(mode) and self.wanted(name)]
+
+    def scan(self, root):
+        return self._walk(root, 0)
+
+    def match(self, root, path):
+        """ Returns (path, ready, files) as scan(root) would yield them for path, or None
+        if path is not one of its submission units. """
+        parts = os.path.relpath(path, root).split(os.sep)
+        if len(parts) != self.depth + 1 or parts[0] in (os.curdir, os.pardir):
+            return None
+        if [part for part in parts if self.skipped(part)]:
+            return None
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
+            return None
+
+        if self.unit == 'file':
+            if stat.S_ISREG(mode) and self.wanted(parts[-1]):
+                return path, True, None
+        elif stat.S_ISDIR(mode):
+            files = self.files(path)
+            return path, self.markers.issubset(files), files
+        return None
+
+    def _walk(self, path, level):
+        for name, full, mode in self.entries(path):
+            if level < self.depth:
+                if stat.S_ISDIR(mode):
+                    for match in self._walk(full, level + 1):
+                        yield match
+
+            elif self.unit == 'file':
+                if stat.S_ISREG(mode) and self.wanted(name):
+                    yield full, True, None
+
+            elif stat.S_ISDIR(mode):
+                files = self.files(full)
+                yield full, self.markers.issubset(files), files
+
+def load_rules(path):
+    """ Reads poller layouts from an ini file with one section per poller name, so new
+    layouts can be added without code. For example:
+
+    [example_poller]
+    depth = 1
+    unit = dir
+    markers = ADI.XML, ADI.DTD
+    exclude = *.tmp, *.partial
+    """
+
+    rules = {}
+    if not path:
+        return rules
+    if not os.path.exists(path):
+        raise ValueError('Rules file does not exist: %s' % path)
+
+    parser = SafeConfigParser()
+    parser.read(path)
+    for name in parser.sections():
+        def get(option, default=''):
+            if parser.has_option(name, option):
+                return parser.get(name, option)
+            return default
+
+        rules[name] = Rule(
+            depth       = get('depth', 0),
+            unit        = get('unit', 'file'),
+            markers     = split_list(get('markers')),
+            include     = split_list(get('include')),
+            exclude     = split_list(get('exclude')),
+            skip_hidden = parser.has_option(name, 'skip_hidden') and parser.getboolean(name, 'skip_hidden'))
+    return rules
@@ -0,0 +1,88 @@
+# scheduler.py
+
+import logging
+
+info = logging.getLogger('scheduler').info
+debug = logging.getLogger('scheduler').debug
+
+class FairScheduler(object):
+    """ Shares the agent's transfer slots between the pollers with deficit round robin.
+    Pollers with queued work first get their minimum number of slots. The remaining
+    slots go round the pollers in proportion to their weights, and a poller never goes
+    past its max_transfers. max_total caps the transfers running on the host across all
+    pollers; 0 means no cap. """
+
+    def __init__(self, max_total=0, weights=None, minimums=None):
+        self.max_total = max_total
+        self.weights = dict((k.lower(), max(float(v), 0.01)) for k, v in (weights or {}).iteritems())
+        self.minimums = dict((k.lower(), int(v)) for k, v in (minimums or {}).iteritems())
+        self.deficits = {}
+        self.start = 0
+
+    def weight(self, poller):
+        return self.weights.get(poller.name.lower(), 1.0)
+
+    def minimum(self, poller):
+        return min(self.minimums.get(poller.name.lower(), 0), self.limit(poller))
+
+    def limit(self, poller):
+        """ The most transfers the poller may run at once. """
+        return poller.max_transfers
+
+    def schedule(self, pollers, transfer_queue, process_list, host_limits=None):
+        """ Returns the pollers to start a transfer for, one entry per transfer. If
+        host_limits is given, it also caps the transfers to each destination host. """
+
+        queued = dict((p.name, len(transfer_queue[p.name])) for p in pollers)
+        active = dict((p.name, len(process_list[p.name])) for p in pollers)
+        host_active = {}
+        for p in pollers:
+            host_active[p.host] = host_active.get(p.host, 0) + active[p.name]
+        if self.max_total:
+            free = self.max_total - sum(len(procs) for procs in process_list.values())
+        else:
+            free = sum(queued.values())
+
+        picks = []
+
+        def eligible(p):
+            if host_limits and host_active[p.host] >= host_limits.get(p.host, 0):
+                return False
+            return queued[p.name] > 0 and active[p.name] < self.limit(p)
+
+        def take(p):
+            picks.append(p)
+            queued[p.name] -= 1
+            active[p.name] += 1
+            host_active[p.host] += 1
+
+        # Guaranteed minimums first
+        for p in pollers:
+            while len(picks) < free and eligible(p) and active[p.name] < self.minimum(p):
+                take(p)
+
+        # Then deficit round robin, starting from a different poller each time
+        order = pollers[self.start:] + pollers[:self.start]
+        if pollers:
+            self.start = (self.start + 1) % len(pollers)
+
+        while len(picks) < free:
+            candidates = [p for p in order if eligible(p)]
+            if not candidates:
+                break
+
+            for p in candidates:
+                if len(picks) >= free:
+                    break
+                deficit = self.deficits.get(p.name, 0) + self.weight(p)
+                while deficit >= 1 and len(picks) < free and eligible(p):
+                    take(p)
+                    deficit -= 1
+                self.deficits[p.name] = deficit
+
+        # A poller with nothing left to send does not bank credit
+        for p in pollers:
+            if not eligible(p):
+                self.deficits[p.name] = 0
+
+        return picks
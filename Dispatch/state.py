@@ -0,0 +1,119 @@
+# state.py
+
+import json
+import logging
+import os
+import stat
+
+info = logging.getLogger('state').info
+debug = logging.getLogger('state').debug
+warning = logging.getLogger('state').warning
+
+# Paths are bytes in whatever encoding made them, latin-1 maps each byte to a character and back
+PATH_ENCODING = 'latin-1'
+
+def fingerprint(source, exclude=None):
+    """ Returns a compact fingerprint of source, or None if it can not be read. A file is
+    [size, mtime]; a directory is [files, total size, newest mtime] of the files directly
+    inside it that do not match the exclude regex, which is the same view is_stable
+    checks. """
+
+    try:
+        st = os.stat(source)
+        if stat.S_ISREG(st.st_mode):
+            return [st.st_size, int(st.st_mtime)]
+
+        count, total, newest = 0, 0, 0
+        for f in os.listdir(source):
+            if exclude and exclude.match(f):
+                continue
+            st = os.stat(os.path.join(source, f))
+            if stat.S_ISREG(st.st_mode):
+                count += 1
+                total += st.st_size
+                newest = max(newest, int(st.st_mtime))
+        return [count, total, newest]
+    except OSError:
+        return None
+
+def entry(item):
+    """ Returns the saved form of a QueueItem: [source, fingerprint], plus the asset id
+    when the item belongs to one. """
+    if item.asset:
+        return [item.source, item.fingerprint, item.asset]
+    return [item.source, item.fingerprint]
+
+def to_bytes(obj):
+    """ Returns obj, as loaded from JSON, with its strings encoded back into the byte
+    strings they were saved from. """
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode(PATH_ENCODING)
+        except UnicodeEncodeError:
+            return obj
+    if isinstance(obj, list):
+        return [to_bytes(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((to_bytes(k), to_bytes(v)) for k, v in obj.iteritems())
+    return obj
+
+class StateStore(object):
+    """ Keeps an on-disk copy of the queued and in-flight transfers, along with the
+    fingerprint each one had when it passed the stability check. A restarted agent
+    loads it to requeue work without rescanning and re-stabilizing everything. """
+
+    def __init__(self, path):
+        self.path = path
+        self._last_saved = None
+
+    def load(self):
+        """ Returns the saved state, or an empty state if there is none. """
+        if not os.path.exists(self.path):
+            return {}
+
+        try:
+            with open(self.path, 'rb') as f:
+                return to_bytes(json.load(f))
+        except (IOError, ValueError), e:
+            warning('Unable to read state file %s: %s' % (self.path, str(e)))
+            return {}
+
+    def save(self, transfer_queue, process_list, assets=None, held=None):
+        """ Writes the current queues, and the assets being delivered, to disk. held is
+        the saved work not restored yet, by poller name, as {'queued': entries, 'assets':
+        assets}; it is written back as it was. Nothing is written if none of it has
+        changed since the last save. """
+
+        queued = dict((name, queue.snapshot()) for name, queue in transfer_queue.items())
+        state = {
+            'queued': dict((name, [entry(i) for i in items]) for name, items in queued.items() if items),
+            'active': dict((name, [entry(p.item) for p in procs])
+                           for name, procs in process_list.items() if procs),
+        }
+        if assets is not None:
+            state['assets'] = assets.to_dict()
+        for name, saved in (held or {}).iteritems():
+            if saved['queued']:
+                state['queued'][name] = saved['queued']
+            for asset_id, a in saved['assets'].iteritems():
+                state.setdefault('assets', {}).setdefault(asset_id, a)
+
+        try:
+            data = json.dumps(state, separators=(',', ':'), sort_keys=True, encoding=PATH_ENCODING)
+        except (TypeError, ValueError), e:
+            warning('Unable to save state file %s: %s' % (self.path, str(e)))
+            return
+        if data == self._last_saved:
+            return
+
+        # Write to a temp file and rename it so a crash never leaves a partial state file
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            self._last_saved = data
+        except (IOError, OSError), e:
+            warning('Unable to save state file %s: %s' % (self.path, str(e)))
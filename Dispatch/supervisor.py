@@ -0,0 +1,386 @@
+# supervisor.py
+
+""" The supervisor is a small, long-lived process that runs the ascp transfers for the
+agent. Transfers keep running while the agent is restarted or upgraded, and the new agent
+re-attaches over a UNIX socket to collect their progress and exit codes.
+
+Requests and replies are single lines of JSON. Their strings are byte strings carried
+as latin-1, as in the state file, so a path in any encoding arrives unchanged. """
+
+import errno
+import json
+import logging
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+
+from daemon import createDaemon
+from progress import Progress
+from records import QueueItem
+from state import PATH_ENCODING, to_bytes
+
+info = logging.getLogger('supervisor').info
+debug = logging.getLogger('supervisor').debug
+warning = logging.getLogger('supervisor').warning
+critical = logging.getLogger('supervisor').critical
+
+# 2: strings are carried as latin-1 bytes instead of UTF-8 text
+PROTOCOL = 2
+
+def dumps(message):
+    """ Returns a request or reply as a line of JSON. """
+    return json.dumps(message, encoding=PATH_ENCODING) + '\n'
+
+def loads(line):
+    """ Returns the request or reply in a line of JSON, with its strings as bytes. """
+    return to_bytes(json.loads(line))
+
+def utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+class Supervisor(object):
+    """ Runs the transfer processes and answers the agent's requests. It exits once it
+    has had no jobs and no agent connected for idle_timeout seconds. """
+
+    def __init__(self, socket_path, spool_dir, idle_timeout=600):
+        self.socket_path = socket_path
+        self.spool_dir = spool_dir
+        self.idle_timeout = idle_timeout
+        self.jobs = {}
+        self.procs = {}
+        self.clients = {}
+        self.counter = 0
+        self.idle_since = time.time()
+
+    def serve(self):
+        """ Main loop. """
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir, 0700)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        os.chmod(self.socket_path, 0600)
+        server.listen(5)
+        info('Supervisor listening on %s, %s' % (self.socket_path, os.getpid()))
+
+        while True:
+            readable, _, _ = select.select([server] + self.clients.keys(), [], [], 1.0)
+            for sock in readable:
+                if sock is server:
+                    conn, _ = server.accept()
+                    self.clients[conn] = ''
+                else:
+                    self.read_client(sock)
+
+            self.reap()
+
+            if self.jobs or self.clients:
+                self.idle_since = time.time()
+            elif time.time() - self.idle_since >= self.idle_timeout:
+                info('Supervisor has been idle for %d secs, exiting.' % self.idle_timeout)
+                break
+
+        server.close()
+        os.unlink(self.socket_path)
+
+    def read_client(self, sock):
+        """ Reads from a connected agent and answers every complete request. """
+        try:
+            data = sock.recv(65536)
+        except socket.error:
+            data = ''
+        if not data:
+            del self.clients[sock]
+            sock.close()
+            return
+
+        buf = self.clients[sock] + data
+        while '\n' in buf:
+            line, buf = buf.split('\n', 1)
+            try:
+                reply = self.handle(loads(line))
+            except Exception, e:
+                reply = {'ok': False, 'error': str(e)}
+            try:
+                sock.sendall(dumps(reply))
+            except socket.error:
+                del self.clients[sock]
+                sock.close()
+                return
+        self.clients[sock] = buf
+
+    def handle(self, request):
+        op = request.get('op')
+        if op == 'ping':
+            return {'ok': True, 'protocol': PROTOCOL, 'pid': os.getpid()}
+        elif op == 'spawn':
+            return {'ok': True, 'job': self.spawn(request['name'], request['source'], request['argv'],
+                                                  request['env'], request.get('meta'))}
+        elif op == 'jobs':
+            return {'ok': True, 'jobs': [self.describe(j) for j in self.jobs.values()]}
+        elif op == 'terminate':
+            proc = self.procs.get(request['id'])
+            if proc and proc.poll() is None:
+                proc.terminate()
+            return {'ok': True}
+        elif op == 'reap':
+            self.forget(request['id'])
+            return {'ok': True}
+        return {'ok': False, 'error': 'Unknown request: %s' % op}
+
+    def spawn(self, name, source, argv, env, meta=None):
+        """ Starts a transfer. meta is kept with the job for the agent and not used here. """
+        self.counter += 1
+        job_id = '%d-%d' % (os.getpid(), self.counter)
+        stdout = open(os.path.join(self.spool_dir, job_id + '.out'), 'wb')
+        stderr = open(os.path.join(self.spool_dir, job_id + '.err'), 'wb')
+        try:
+            proc = subprocess.Popen(argv, env=env, stdout=stdout, stderr=stderr, close_fds=True)
+        finally:
+            stdout.close()
+            stderr.close()
+
+        info('Started %s for %s (pid %d)' % (source, name, proc.pid))
+        self.procs[job_id] = proc
+        self.jobs[job_id] = {
+            'id': job_id,
+            'name': name,
+            'source': source,
+            'pid': proc.pid,
+            'started': time.time(),
+            'returncode': None,
+            'meta': meta or {},
+        }
+        return self.describe(self.jobs[job_id])
+
+    def describe(self, job):
+        """ Returns the job along with how much output it has written so far, which is how
+        the agent tracks progress. """
+        job = dict(job)
+        try:
+            st = os.stat(os.path.join(self.spool_dir, job['id'] + '.out'))
+            job['output'] = st.st_size
+            job['updated'] = st.st_mtime
+        except OSError:
+            job['output'] = 0
+            job['updated'] = job['started']
+        return job
+
+    def reap(self):
+        for job_id, proc in self.procs.items():
+            if proc.poll() is not None:
+                info('%s for %s exited with %d' % (self.jobs[job_id]['source'],
+                     self.jobs[job_id]['name'], proc.returncode))
+                self.jobs[job_id]['returncode'] = proc.returncode
+                del self.procs[job_id]
+
+    def forget(self, job_id):
+        """ Drops a finished job once the agent has collected it. """
+        if job_id in self.procs:
+            raise Exception('Job %s is still running' % job_id)
+        self.jobs.pop(job_id, None)
+        for ext in ('.out', '.err'):
+            try:
+                os.remove(os.path.join(self.spool_dir, job_id + ext))
+            except OSError:
+                pass
+
+class SupervisorClient(object):
+    """ The agent's connection to the supervisor. The supervisor is started on first use
+    if it is not already running. """
+
+    def __init__(self, socket_path, log_file=None):
+        self.socket_path = socket_path
+        self.spool_dir = socket_path + '.spool'
+        self.log_file = log_file
+        self.sock = None
+        self.buf = ''
+        self._jobs = {}
+        self._jobs_time = 0
+
+    def connect(self):
+        for attempt in range(50):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except socket.error, e:
+                sock.close()
+                if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                    raise
+                if attempt == 0:
+                    self.launch()
+                time.sleep(0.1)
+                continue
+
+            sock.settimeout(30)
+            self.sock = sock
+            self.buf = ''
+            reply = self.request('ping')
+            if reply['protocol'] != PROTOCOL:
+                warning('Supervisor speaks protocol %s, expected %s' % (reply['protocol'], PROTOCOL))
+            info('Attached to transfer supervisor, %s' % reply['pid'])
+            return
+
+        raise Exception('Unable to connect to the supervisor at %s' % self.socket_path)
+
+    def launch(self):
+        info('Starting transfer supervisor')
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        args = [sys.executable, script, self.socket_path, self.spool_dir]
+        if self.log_file:
+            args.append(self.log_file)
+        # The supervisor daemonizes itself, so this returns right away
+        subprocess.call(args, close_fds=True)
+
+    def request(self, op, **kwargs):
+        """ Sends a request and returns the reply, reconnecting once if the connection was
+        lost. """
+        kwargs['op'] = op
+        for attempt in range(2):
+            try:
+                if not self.sock:
+                    self.connect()
+                self.sock.sendall(dumps(kwargs))
+                while '\n' not in self.buf:
+                    data = self.sock.recv(65536)
+                    if not data:
+                        raise socket.error(errno.ECONNRESET, 'Supervisor closed the connection')
+                    self.buf += data
+                line, self.buf = self.buf.split('\n', 1)
+                break
+            except socket.error:
+                self.close()
+                if attempt:
+                    raise
+
+        reply = loads(line)
+        if not reply.get('ok'):
+            raise Exception('Supervisor error: %s' % reply.get('error'))
+        return reply
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+
+    def spawn(self, name, item, argv, env):
+        # Settings read from the database may be unicode, exec takes them as UTF-8
+        argv = [utf8(a) for a in argv]
+        env = dict((utf8(k), utf8(v)) for k, v in env.iteritems())
+        meta = {'fingerprint': item.fingerprint, 'attempts': item.attempts, 'log_id': item.log_id,
+                'asset': item.asset, 'size': item.size, 'package': item.package}
+        job = self.request('spawn', name=name, source=item.source, argv=argv, env=env, meta=meta)['job']
+        self._jobs[job['id']] = job
+        return SupervisedProcess(self, job)
+
+    def jobs(self):
+        """ Returns the supervisor's jobs by id. One request serves every check made
+        within the same second. """
+        if time.time() - self._jobs_time >= 1:
+            self._jobs = dict((j['id'], j) for j in self.request('jobs')['jobs'])
+            self._jobs_time = time.time()
+        return self._jobs
+
+    def attach(self):
+        """ Returns a SupervisedProcess for every job the supervisor is running. """
+        self._jobs_time = 0
+        return [SupervisedProcess(self, job) for job in self.jobs().values()]
+
+class SupervisedProcess(object):
+    """ Stands in for an ExtendedPopen when the transfer runs under the supervisor. The
+    output is read from the supervisor's spool files. """
+
+    def __init__(self, client, job):
+        self.client = client
+        self.job_id = job['id']
+        self.name = job['name']
+        self.source = job['source']
+        self.item = QueueItem(job['source'], **dict((str(k), v) for k, v in job['meta'].iteritems()))
+        self.pid = job['pid']
+        self.returncode = job['returncode']
+        self.started = job['started']
+        self.stalled = None
+        self.progress = Progress()
+        self._stdout = None
+        self._stderr = None
+        self._offset = 0
+
+    def poll(self):
+        if self.returncode is None:
+            job = self.client.jobs().get(self.job_id)
+            if job is None:
+                # The supervisor went away and took the transfer with it
+                self.returncode = -1
+            else:
+                self.returncode = job['returncode']
+        return self.returncode
+
+    def terminate(self):
+        self.client.request('terminate', id=self.job_id)
+
+    @property
+    def stdout(self):
+        if self._stdout is None:
+            self._stdout = self._open('.out')
+        return self._stdout
+
+    @property
+    def stderr(self):
+        if self._stderr is None:
+            self._stderr = self._open('.err')
+        return self._stderr
+
+    def read_output(self):
+        """ Reads whatever ascp has written to the spool since the last call. Returns how
+        many more bytes it reports sent. """
+        self.stdout.seek(self._offset)
+        data = self.stdout.read()
+        self._offset += len(data)
+        return self.progress.feed(data)
+
+    def _open(self, ext):
+        try:
+            return open(os.path.join(self.client.spool_dir, self.job_id + ext), 'rb')
+        except IOError:
+            return open(os.devnull, 'rb')
+
+    def release(self):
+        """ Closes the output files and tells the supervisor the job has been collected. """
+        for f in (self._stdout, self._stderr):
+            if f:
+                f.close()
+        try:
+            self.client.request('reap', id=self.job_id)
+        except Exception, e:
+            warning('Unable to release supervisor job %s: %s' % (self.job_id, str(e)))
+
+if __name__ == '__main__':
+    socket_path, spool_dir = sys.argv[1:3]
+    log_file = sys.argv[3] if len(sys.argv) > 3 else None
+
+    retCode = createDaemon()
+    if retCode != 0:
+        sys.exit(1)
+    os.umask(077)
+
+    if log_file:
+        fh = logging.FileHandler(log_file, 'a')
+        fh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p'))
+        logging.getLogger().addHandler(fh)
+        logging.getLogger().setLevel(logging.INFO)
+
+    try:
+        Supervisor(socket_path, spool_dir).serve()
+    except Exception, e:
+        critical('Supervisor exited abnormally: %s' % str(e))
+        sys.exit(1)
@@ -1,19 +1,31 @@
+import json
 import logging
 import multiprocessing
 import os
-import shutil
 import signal
-import subprocess
 import sys
 import time
 from collections import deque
 from datetime import datetime
 from socket import gethostname
 
+import metrics
+import packager
+from assets import AssetRegistry
+from cleanup import CleanupManager
 from daemon import createDaemon
-from pollers import PollerManager
+from intake import IntakeServer, IntakeTarget
+from pollers import PollerManager, Watermarks, accepts_intake, layout
+from records import QueueItem, TransferQueue
+from rules import load_rules, compile_globs, split_list
+from scheduler import FairScheduler
+from state import StateStore, fingerprint
+from supervisor import SupervisorClient, SupervisedProcess
 from table_def import Poller, TransferLog, ErrorMgr
-from util import die, send_email, getsize
+from transports import AsperaTransport, LocalTransport, LocalCopy, is_local
+from tuning import ConcurrencyController
+from workers import WorkerPool
+from util import die, send_email, getsize, memory_usage, flush_logging, PathChecker
 
 from sqlalchemy import create_engine, and_
 from sqlalchemy.orm import sessionmaker
@@ -23,6 +35,19 @@ debug = logging.getLogger('transfermanager').debug
 warning = logging.getLogger('transfermanager').warning
 critical = logging.getLogger('transfermanager').critical
 
+# How often the metrics are logged and written to the status file
+METRICS_INTERVAL = 60
+
+# The longest a stalled transfer waits before it is retried
+MAX_STALL_BACKOFF = 3600
+
+# How long the poller paths are given to answer at startup, and when retried
+PATH_CHECK_TIMEOUT = 10
+PATH_RETRY_TIMEOUT = 2
+
+# How often the paths of quarantined pollers are checked again
+QUARANTINE_RETRY = 60
+
 class TransferManager:
     """
     The TransferManager spawns a PollerManager which executes each poller. The pollers
@@ -31,23 +56,60 @@ class TransferManager:
     the database.
     """
 
-    def __init__(self, settings, lock_file, daemon):
+    def __init__(self, settings, lock_file, daemon, started=None):
         info('Creating TransferManager')
         self.__db_user = settings['DB_USER']
         self.__db_pass = settings['DB_PASS']
         self.__db_name = settings['DB_NAME']
         self.__db_server = settings['DB_SERVER']
-        self.__poll_interval = settings['POLL_INTERVAL']
+        self.__poll_min = settings['POLL_INTERVAL_MIN']
+        self.__poll_max = settings['POLL_INTERVAL_MAX']
         self.__daemon_log = settings['DAEMON_LOG']
-        self.__ssh_keys = settings['SSH_KEYS']
+        self.__supervisor_socket = settings['SUPERVISOR_SOCKET']
+        self.__cleanup_workers = settings['CLEANUP_WORKERS']
+        self.__status_file = settings['STATUS_FILE']
+        self.__rules_file = settings['RULES_FILE']
+        self.__progressive = split_list(settings['PROGRESSIVE_POLLERS'])
+        self.__package = split_list(settings['PACKAGE_POLLERS'])
+        self.__poller_workers = settings['POLLER_WORKERS']
+        self.__stall_timeout = settings['STALL_TIMEOUT']
+        self.__stall_min_rate = settings['STALL_MIN_RATE']
+        self.__stall_backoff = settings['STALL_BACKOFF']
+        self.__watermarks = {None: Watermarks(settings['QUEUE_HIGH_WATER'], settings['QUEUE_LOW_WATER'])}
+        for name, high in settings['POLLER_HIGH_WATER'].iteritems():
+            self.__watermarks[name] = Watermarks(high, settings['POLLER_LOW_WATER'].get(name))
+        self.__agent_watermarks = Watermarks(settings['AGENT_HIGH_WATER'], settings['AGENT_LOW_WATER'])
+        self.__intake_socket = settings['INTAKE_SOCKET']
+        self.__detect_writers = settings['STABILITY_CHECK'] != 'timed'
         self.lock_file = lock_file
         self.daemon = daemon
         self.transfer_queue = {}
         self.process_list = {}
+        self.state = StateStore(settings['STATE_FILE'])
+        self.assets = AssetRegistry()
+        self.supervisor = None
+        self.intake = None
+        self.rules = {}
+        self.started = started or time.time()
+        self.first_transfer = None
+        self.paths = PathChecker()
+        self.quarantined = {}
+        self.held = {}
+        self.quarantine_time = time.time()
+        self.metrics_time = time.time()
+        self.aspera = AsperaTransport(settings['SSH_KEYS'])
+        self.local = LocalTransport(settings['LOCAL_COPY_WORKERS'])
+        self.exclude_cache = {}
+        self.scheduler = FairScheduler(settings['MAX_TOTAL_TRANSFERS'], settings['POLLER_WEIGHTS'],
+                                       settings['POLLER_MINIMUMS'])
+        self.tuner = None
+        if settings['AUTOTUNE']:
+            self.tuner = ConcurrencyController(settings['AUTOTUNE_INTERVAL'], settings['AUTOTUNE_MIN'])
 
         if daemon:
             info('Launching Dispatch daemon...')
             self.lock_file.remove()
+            flush_logging()
             
             retCode = createDaemon()                                                                                        
             debug(retCode)
@@ -93,21 +155,199 @@ class TransferManager:
             critical('Error gathering subpollers: %s' % str(err))
             sys.exit(1)
 
+        self.pollers = self.usable_pollers(self.pollers)
+        self.reset_errors(*[p.name for p in self.pollers])
+
+        # Started after daemonizing so the workers belong to the daemon
+        self.cleanup = CleanupManager(self.__cleanup_workers)
         for p in self.pollers:
-            if not os.path.exists(p.path):
-                self.lock_file.remove()
-                critical('Poller path for %s does not exist: %s' % (p.name, p.path))
-                sys.exit(1)
-            self.reset_errors(p.name)
+            self.cleanup.purge(p.path)
+
+        self.attach_transfers()
+        self.restore_state()
 
         info('Forking poller manager')
         try:
-            self.pollermgr = PollerManager(self.pollers, self.transfer_queue, self.process_list, self.__poll_interval)
+            self.pollermgr = self.create_poller_mgr()
             self.pollermgr.start()
         except Exception, e:
             self.lock_file.remove()
             die('Error starting poller manager', e)
 
+        if self.__intake_socket:
+            self.intake = IntakeServer(self.__intake_socket, self.transfer_queue, self.process_list)
+            self.update_intake()
+            self.intake.start()
+
+        startup = time.time() - self.started
+        info('Started %d pollers in %.1f secs, %d quarantined' % (len(self.pollers), startup, len(self.quarantined)))
+        metrics.gauge('agent.startup_secs', round(startup, 1))
+
+    def usable_pollers(self, pollers):
+        """ Returns the pollers whose paths are there. The others are quarantined and
+        their paths checked again every QUARANTINE_RETRY secs, so one unmounted volume
+        does not hold up the rest. """
+
+        found = self.paths.existing([p.path for p in pollers], PATH_CHECK_TIMEOUT)
+        usable = []
+        for p in pollers:
+            if p.path in found:
+                usable.append(p)
+            elif p.name not in self.quarantined:
+                critical('Poller path for %s does not exist or is not responding, quarantining it: %s' % (p.name, p.path))
+                self.quarantined[p.name] = p
+        metrics.gauge('pollers.quarantined', len(self.quarantined))
+        return usable
+
+    def retry_quarantined(self):
+        """ Takes the pollers whose paths have come back out of quarantine, so the
+        poller update starts them. """
+
+        if not self.quarantined or time.time() - self.quarantine_time < QUARANTINE_RETRY:
+            return
+        self.quarantine_time = time.time()
+
+        found = self.paths.existing([p.path for p in self.quarantined.values()], PATH_RETRY_TIMEOUT)
+        for name, p in self.quarantined.items():
+            if p.path in found:
+                info('Poller path for %s is back: %s' % (name, p.path))
+                del self.quarantined[name]
+        metrics.gauge('pollers.quarantined', len(self.quarantined))
+
+    def update_intake(self):
+        """ Points the intake at the current pollers, with the layouts they scan with.
+        Pollers that track their assets from the scans do not take pushed items. """
+        if not self.intake:
+            return
+        targets = {}
+        for p in self.pollers:
+            if p.name not in self.__progressive and accepts_intake(p.poller_type):
+                watermarks = self.__watermarks.get(p.name.lower(), self.__watermarks[None])
+                matcher = layout(p.poller_type, self.rules.get(p.name), split_list(p.excludes))
+                targets[p.name] = IntakeTarget(p.path, self.poller_exclude(p), watermarks, matcher)
+        self.intake.set_targets(targets)
+
+    def create_poller_mgr(self):
+        """ Returns a new PollerManager for the current pollers, or a WorkerPool running
+        them in POLLER_WORKERS processes. The rules file is read again so layout changes
+        are picked up along with the poller changes. """
+        try:
+            rules = load_rules(self.__rules_file)
+        except Exception, err:
+            critical('Error reading rules file %s: %s' % (self.__rules_file, str(err)))
+            rules = {}
+        self.rules = rules
+        if self.__poller_workers:
+            return WorkerPool(self.__poller_workers, self.pollers, self.transfer_queue, self.process_list,
+                              self.__poll_min, self.__poll_max, rules, self.assets, self.__progressive,
+                              self.__watermarks, self.__agent_watermarks, self.__detect_writers, self.__package)
+        return PollerManager(self.pollers, self.transfer_queue, self.process_list, self.__poll_min, self.__poll_max, rules,
+                             self.assets, self.__progressive, self.__watermarks, self.__agent_watermarks,
+                             self.__detect_writers, self.__package)
+
+    def attach_transfers(self):
+        """ Re-attaches to the transfers the supervisor kept running while the agent was
+        down. Their TransferLog rows were left as Transferring, so check_procs finishes
+        them like any other transfer. """
+
+        if not self.__supervisor_socket:
+            return
+
+        self.supervisor = SupervisorClient(self.__supervisor_socket, self.__daemon_log)
+        self.aspera.supervisor = self.supervisor
+        # A quarantined poller is still enabled, its transfers carry on and are collected as usual
+        names = set(p.name for p in self.pollers) | set(self.quarantined)
+        for proc in self.supervisor.attach():
+            if proc.name in names:
+                info('Re-attached to %s for %s' % (proc.source, proc.name))
+                self.transfer_queue.setdefault(proc.name, TransferQueue())
+                self.process_list.setdefault(proc.name, []).append(proc)
+            elif proc.poll() is None:
+                warning('Terminating %s, %s is no longer enabled' % (proc.source, proc.name))
+                proc.terminate()
+            else:
+                proc.release()
+
+    def restore_state(self):
+        """ Requeues the work saved by the previous agent. Interrupted transfers go to the
+        front of the queue and pick up where they stopped through ascp's -k2 resume. Saved
+        items that are unchanged since they passed the stability check skip discovery and
+        the stability wait; anything else is left for the pollers to find again. The
+        assets being delivered are restored too, so their markers still follow.
+
+        The paths of quarantined pollers can not be checked, so their saved work is held,
+        and saved again as it was, until they are back. """
+
+        saved = self.state.load()
+        for name in self.quarantined:
+            self.held[name] = {
+                'queued': saved.get('active', {}).get(name, []) + saved.get('queued', {}).get(name, []),
+                'assets': dict((k, a) for k, a in saved.get('assets', {}).iteritems() if a['poller'] == name),
+            }
+        self.restore(self.pollers, saved.get('active', {}), saved.get('queued', {}), saved.get('assets', {}))
+
+    def restore_held(self):
+        """ Requeues the held work of the pollers that are back from quarantine. """
+        pollers = [p for p in self.pollers if p.name in self.held]
+        if not pollers:
+            return
+        queued, assets = {}, {}
+        for p in pollers:
+            held = self.held.pop(p.name)
+            queued[p.name] = held['queued']
+            assets.update(held['assets'])
+        self.restore(pollers, {}, queued, assets)
+
+    def restore(self, pollers, active, queued, assets):
+        """ Requeues the saved work of the given pollers, see restore_state. """
+
+        pollers = dict((p.name, p) for p in pollers)
+        running = set(p.source for procs in self.process_list.values() for p in procs)
+        restored = 0
+        self.assets.load(assets, pollers)
+
+        # Interrupted transfers first so they resume before anything new starts
+        for saved in (active, queued):
+            for name, items in saved.iteritems():
+                if name not in pollers:
+                    continue
+                exclude = self.poller_exclude(pollers[name])
+
+                queue = self.transfer_queue.setdefault(name, TransferQueue())
+                self.process_list.setdefault(name, [])
+                for entry in items:
+                    source, fp = entry[:2]
+                    asset = entry[2] if len(entry) > 2 and entry[2] in self.assets else None
+                    if source in running or source in queue:
+                        continue
+                    # A packaged directory is only restored along with its finished tar
+                    package = None
+                    if name in self.__package and os.path.isdir(source):
+                        package = packager.staged(pollers[name].path, source)
+                        if not os.path.isfile(package):
+                            continue
+                    if fp is not None and fingerprint(source, exclude) == fp:
+                        queue.append(QueueItem(source, fp, asset=asset, package=package))
+                        restored += 1
+                    else:
+                        debug('Not restoring %s, it has changed or is gone' % source)
+
+        # A marker the pollers do not look for, which may not have been queued in time
+        for asset in self.assets.assets.values():
+            if asset.poller not in pollers:
+                continue
+            queue = self.transfer_queue.setdefault(asset.poller, TransferQueue())
+            self.process_list.setdefault(asset.poller, [])
+            for source in asset.pending & asset.markers:
+                if source not in running and source not in queue:
+                    open(source, 'a').close()
+                    queue.append(QueueItem(source, fingerprint(source), asset=asset.id))
+                    restored += 1
+
+        if restored:
+            info('Restored %d queued transfers for %s from %s' % (restored, ', '.join(sorted(pollers)),
+                                                                 self.state.path))
+
     def kill_daemon(self, sigum, frame):
         info('Dispatch daemon is shutting down...')
         self.clean_up_transfers()
@@ -119,16 +359,17 @@ class TransferManager:
         self.pollermgr.stop()
         self.pollermgr.join()
 
+        # Transfers under the supervisor keep running, there is nothing to wait for
+        if self.supervisor:
+            info('Leaving running transfers with the transfer supervisor')
+
         for name, proclist in self.process_list.iteritems():
-                done = False
-                while not done:
-                    if proclist:
-                        info('Waiting for %s transfers to finish...' % name)
-                        self.check_procs()
-                        time.sleep(5)
-                    else:
-                        done = True
+            while [p for p in proclist if not isinstance(p, SupervisedProcess)]:
+                info('Waiting for %s transfers to finish...' % name)
+                self.check_procs()
+                time.sleep(5)
 
+        self.state.save(self.transfer_queue, self.process_list, self.assets, self.held)
         self.session.commit()
         self.session.close_all()
         info('Dispatch shutdown successfully.')
@@ -145,12 +386,33 @@ class TransferManager:
         sys.exit(0)
 
     def clean_up_transfers(self):
+        # Save the running transfers first so the next agent resumes them
+        self.state.save(self.transfer_queue, self.process_list, self.assets, self.held)
+
+        if self.supervisor:
+            info('Leaving running transfers with the transfer supervisor')
+
+            # Local copies run in the agent and stop with it
+            local = [p for procs in self.process_list.values() for p in procs if isinstance(p, LocalCopy)]
+            for p in local:
+                p.terminate()
+            transfers = [self.session.query(TransferLog).get(p.item.log_id) for p in local if p.item.log_id]
+            for t in transfers:
+                if t:
+                    t.ended = datetime.utcnow()
+                    t.status = 'Cancelled'
+                    t.error = 'Interrupted by agent shutdown, it will resume when the agent restarts.'
+            self.session.commit()
+            self.session.close_all()
+            return
+
         transfers = self.session.query(TransferLog).\
             filter(TransferLog.status=='Transferring').all()
 
         for t in transfers:
             t.ended = datetime.utcnow()
             t.status = 'Cancelled'
+            t.error = 'Interrupted by agent shutdown, it will resume when the agent restarts.'
 
         for name, proclist in self.process_list.iteritems():
             if proclist:
@@ -182,6 +444,16 @@ class TransferManager:
 
 #        debug('Checking for updated pollers...')
         new_pollers = self.session.query(Poller).filter(Poller.enabled == True).all()
+
+        # Quarantined pollers are left out until their paths are back
+        enabled = set(p.name for p in new_pollers)
+        for name in self.quarantined.keys():
+            if name not in enabled:
+                del self.quarantined[name]
+                self.held.pop(name, None)
+        self.retry_quarantined()
+        new_pollers = [p for p in new_pollers if p.name not in self.quarantined]
+
         if new_pollers != self.pollers:
             info('Found updated pollers, restarting poller_mgr...')
 
@@ -191,11 +463,12 @@ class TransferManager:
                 self.pollermgr.stop()
                 self.pollermgr.join()
 
-                self.pollers = new_pollers
-                for p in self.pollers:
-                    self.reset_errors(p.name)
-                self.pollermgr = PollerManager(self.pollers, self.transfer_queue, self.process_list, self.__poll_interval)
+                self.pollers = self.usable_pollers(new_pollers)
+                self.reset_errors(*[p.name for p in self.pollers])
+                self.restore_held()
+                self.pollermgr = self.create_poller_mgr()
                 self.pollermgr.start()
+                self.update_intake()
 
             # Removing a poller, more complicated
             elif len(new_pollers) < len(self.pollers):
@@ -207,6 +480,7 @@ class TransferManager:
                     info('Removing poller: %s' % p.name)
                     del self.transfer_queue[p.name]
                     del self.process_list[p.name]
+                    self.assets.forget_poller(p.name)
 
                     # Cleanup any transfer logs in the database
                     running_transfers = self.session.query(TransferLog).\
@@ -220,18 +494,24 @@ class TransferManager:
                         t.error = 'Cancelled because the poller was disabled.'
 
                     self.session.commit()
+                    for t in running_transfers:
+                        self.session.expunge(t)
 
                 self.pollers = new_pollers
-                self.pollermgr = PollerManager(self.pollers, self.transfer_queue, self.process_list, self.__poll_interval)
+                self.pollermgr = self.create_poller_mgr()
                 self.pollermgr.start()
-
-    def reset_errors(self, poller_name):
-#        debug('Reseting errors on %s poller' % poller_name)
-        perror = self.session.query(ErrorMgr).filter(ErrorMgr.name == poller_name).first()
-        if perror.total_errors != 0:
-            perror.total_errors = 0
-            perror.time_disabled = None
-            perror.locking_agent = None
+                self.update_intake()
+
+    def reset_errors(self, *poller_names):
+        """ Clears the errors of the named pollers in a single update. """
+        if not poller_names:
+            return
+#        debug('Reseting errors on %s' % ', '.join(poller_names))
+        reset = self.session.query(ErrorMgr).\
+                filter(ErrorMgr.name.in_(poller_names)).\
+                filter(ErrorMgr.total_errors != 0).\
+                update({'total_errors': 0, 'time_disabled': None, 'locking_agent': None}, synchronize_session=False)
+        if reset:
             self.session.commit()
 
     def run_loop(self):
@@ -240,61 +520,99 @@ class TransferManager:
 
         while True:
 
-            for poller in self.pollers:
-#                debug('%s queue: %s' % (poller.name, self.transfer_queue[poller.name]))
+            # Pick up what the poller workers have found
+            if self.__poller_workers:
+                self.pollermgr.pump()
 
-                # While number of current processes < max_transfers and the number of elements in the queue are > 0.
-                while (len(self.process_list[poller.name]) < poller.max_transfers) and (len(self.transfer_queue[poller.name]) > 0):
-                    source = self.transfer_queue[poller.name].pop(0)
-                    if source:
-                        self.transfer(poller, source)
+            # Fill the free slots fairly across the pollers
+            host_limits = self.tuner.limits(self.pollers) if self.tuner else None
+            for poller in self.scheduler.schedule(self.pollers, self.transfer_queue, self.process_list, host_limits):
+                item = self.transfer_queue[poller.name].popleft()
+                self.transfer(poller, item)
 
             # Commit sessions and expire queries and sleep
             self.session.commit()
             time.sleep(2)
 
             self.check_procs()
+            if self.tuner:
+                self.tuner.evaluate(self.pollers, self.transfer_queue, self.process_list)
             self.check_poller_updates()
-
-    def transfer(self, poller, source):
+            self.state.save(self.transfer_queue, self.process_list, self.assets, self.held)
+            self.report_metrics()
+
+    def report_metrics(self):
+        """ Logs the metrics and writes them to the status file once a minute. """
+        if time.time() - self.metrics_time < METRICS_INTERVAL:
+            return
+        self.metrics_time = time.time()
+
+        for name, procs in self.process_list.iteritems():
+            metrics.gauge('transfers.%s.active' % name, len(procs))
+            metrics.gauge('transfers.%s.queued' % name, len(self.transfer_queue.get(name, [])))
+            if name in self.transfer_queue:
+                metrics.gauge('transfers.%s.deferred' % name, self.transfer_queue[name].waiting())
+        metrics.gauge('agent.rss', memory_usage())
+        metrics.gauge('agent.session_objects', len(self.session.identity_map))
+
+        snapshot = metrics.snapshot()
+        debug('Metrics: %s' % json.dumps(snapshot, sort_keys=True))
+        if self.__status_file:
+            try:
+                with open(self.__status_file + '.tmp', 'wb') as f:
+                    json.dump(snapshot, f, sort_keys=True, indent=1)
+                os.rename(self.__status_file + '.tmp', self.__status_file)
+            except (IOError, OSError), err:
+                warning('Unable to write status file %s: %s' % (self.__status_file, str(err)))
+
+    def poller_exclude(self, poller):
+        """ Returns the poller's compiled excludes, compiled again only when they change. """
+        cached = self.exclude_cache.get(poller.name)
+        if not cached or cached[0] != poller.excludes:
+            cached = (poller.excludes, compile_globs(split_list(poller.excludes)))
+            self.exclude_cache[poller.name] = cached
+        return cached[1]
+
+    def transfer(self, poller, item):
+        source = item.source
         info('Transferring %s' % source)
-        
-        aspera_cmd = ""
-
-        # Build ascp command
-        if poller.password:                                                                                                                                 
-            aspera_cmd += 'ASPERA_SCP_PASS="%s" ' % str(poller.password).encode('string-escape')
-
-        if poller.encrypt:
-            aspera_cmd += 'ASPERA_SCP_FILEPASS=%s ' % str(poller.encrypt_passphrase).encode('string-escape')
-        
-        aspera_cmd += '/bin/ascp --ignore-host-key -k2 -d -l %sM -m 10K -TQ -P %d ' % (poller.transfer_speed, int(poller.ssh_port))
-        
-        if poller.ssh_key:
-            key_name = os.path.join(self.__ssh_keys, poller.name + '.pub')
-            with open(key_name, 'wb') as f:
-                f.write(poller.ssh_key)
-            aspera_cmd += '-i %s ' % key_name
-
-        if poller.encrypt:
-            aspera_cmd += '--file-crypt=encrypt '
-        
-        aspera_cmd += '--src-base=%s %s %s@%s:/' % (poller.path, source, poller.username, poller.host)
-        
-        if poller.destination:
-            aspera_cmd += '%s/' % poller.destination
-        
-#        debug('Compiled command: %s' % aspera_cmd)
-
-#        aspera_cmd = 'sleep 2'
-
-        # Update the database
-        new_transfer = TransferLog(poller.name, source, 'Transferring', gethostname(), getsize(source))
+
+        # Update the database, only the row id is kept once it is committed
+        item.size = getsize(item.package or source, self.poller_exclude(poller))
+        new_transfer = TransferLog(poller.name, source, 'Transferring', gethostname(), item.size)
         self.session.add(new_transfer)
         self.session.commit()
+        item.log_id = new_transfer.id
+        self.session.expunge(new_transfer)
+
+        # Start it and add it to process_list
+        transport = self.local if is_local(poller) else self.aspera
+        try:
+            proc = transport.start(poller, item, self.poller_exclude(poller))
+        except Exception, err:
+            # Such as a missing ascp, it fails like a transfer that errored
+            warning('%s for %s failed to start: %s' % (source, poller.name, str(err)))
+            metrics.incr('transfers.failed')
+            res = self.session.query(TransferLog).get(item.log_id)
+            res.status = 'Error'
+            res.ended = datetime.utcnow()
+            res.error = 'Unable to start the transfer: %s' % str(err)
+
+            item.attempts += 1
+            item.log_id = None
+            self.transfer_queue[poller.name].append(item)
+            if self.tuner:
+                self.tuner.failure(poller.host)
+            self.count_error(poller.name, res.error)
+            self.session.commit()
+            self.session.expunge(res)
+            return
+        self.process_list[poller.name].append(proc)
 
-        # Create process and add to process_list
-        self.process_list[poller.name].append(ExtendedPopen(poller.name, source, aspera_cmd))
+        if self.first_transfer is None:
+            self.first_transfer = time.time() - self.started
+            info('First transfer started %.1f secs after startup' % self.first_transfer)
+            metrics.gauge('agent.time_to_first_transfer', round(self.first_transfer, 1))
 
     def check_procs(self):
 
@@ -305,25 +623,39 @@ class TransferManager:
         def failure():
             pass
 
+        hosts = dict((x.name, x.host) for x in self.pollers)
+
 #        debug('Checking current processes...')
         for poller, procs in self.process_list.iteritems():
-            for p in procs:
+            for p in procs[:]:
+                sent = p.read_output()
+                if self.tuner:
+                    self.tuner.record(hosts.get(poller), sent)
+
+                # A hung transfer would keep its slot forever
+                if not p.stalled and not done(p):
+                    p.stalled = self.stalled(p)
+                    if p.stalled:
+                        warning('%s for %s has stalled, terminating it: %s' % (p.source, p.name, p.stalled))
+                        p.terminate()
+
                 if done(p):
-                    res = self.session.query(TransferLog).\
-                        filter(TransferLog.name==poller).\
-                        filter(TransferLog.filename==p.source).\
-                        filter(TransferLog.status=='Transferring').\
-                        order_by('-id').first()
+                    res = None
+                    if p.item.log_id:
+                        res = self.session.query(TransferLog).get(p.item.log_id)
+                    if not res:
+                        res = self.session.query(TransferLog).\
+                            filter(TransferLog.name==poller).\
+                            filter(TransferLog.filename==p.source).\
+                            filter(TransferLog.status=='Transferring').\
+                            order_by('-id').first()
                     if success(p):
                         debug('%s for %s was successful' % (p.source, p.name))
-                        try:
-                            debug('Removing %s' % p.source)
-                            if os.path.isfile(p.source):
-                                os.remove(p.source)
-                            else:
-                                shutil.rmtree(p.source)
-                        except OSError as err:
-                            critical('Error removing %s: %s' % (p.source, str(err)))
+                        debug('Removing %s' % p.source)
+                        metrics.incr('transfers.complete')
+                        self.cleanup.remove(self.poller_path(poller, p.source), p.source)
+                        if p.item.package:
+                            self.cleanup.remove(self.poller_path(poller, p.source), p.item.package)
 
                         res.status = 'Complete'
                         res.ended = datetime.utcnow()
@@ -331,13 +663,55 @@ class TransferManager:
                         # Check for error and reset error counter
                         self.reset_errors(p.name)
 
+                        # Move its asset on, a completed stage queues the next one at once
+                        if p.item.asset:
+                            items, asset = self.assets.completed(p.item)
+                            for item in reversed(items):
+                                self.transfer_queue[poller].appendleft(item)
+                            if asset and os.path.isdir(asset.id):
+                                left = self.undelivered(poller, asset)
+                                if left:
+                                    warning('Keeping asset dir %s, %s arrived too late and were not sent'
+                                            % (asset.id, ', '.join(left)))
+                                else:
+                                    debug('Removing asset dir %s' % asset.id)
+                                    self.cleanup.remove(self.poller_path(poller, asset.id), asset.id)
+
+                        # The poller's worker may submit the source again if it comes back
+                        if self.__poller_workers:
+                            self.pollermgr.release(poller, p.source, p.item.asset)
+
+                        # Count whatever the progress output did not report
+                        if self.tuner and res.filesize:
+                            self.tuner.record(hosts.get(poller), res.filesize - p.progress.bytes)
+
+                    elif p.stalled:
+                        metrics.incr('transfers.stalled')
+
+                        # Requeue it, waiting longer each time it stalls
+                        p.item.attempts += 1
+                        p.item.log_id = None
+                        delay = min(self.__stall_backoff * 2 ** (p.item.attempts - 1), MAX_STALL_BACKOFF)
+                        self.transfer_queue[poller].defer(p.item, time.time() + delay)
+                        info('Retrying %s for %s in %d secs' % (p.source, p.name, delay))
+                        if self.tuner:
+                            self.tuner.failure(hosts.get(poller))
+
+                        res.status = 'Stalled'
+                        res.ended = datetime.utcnow()
+                        res.error = p.stalled
+
                     else:
                         warning('%s for %s failed!' % (p.source, p.name))
+                        metrics.incr('transfers.failed')
 
                         # Re-add to transfer_queue to attempt again
-                        self.transfer_queue[poller].append(p.source)
+                        p.item.attempts += 1
+                        p.item.log_id = None
+                        self.transfer_queue[poller].append(p.item)
+                        if self.tuner:
+                            self.tuner.failure(hosts.get(poller))
 
-                        stdout = p.stdout.read().strip()
                         stderr = p.stderr.read().strip()
 
                         res.status = 'Error'
@@ -348,29 +722,67 @@ class TransferManager:
                             res.error = 'No error given: %s' % str(p.returncode)
 
                         # Update the error table, disable poller if required
-                        perror = self.session.query(ErrorMgr).filter(ErrorMgr.name==p.name).first()
-                        perror.total_errors += 1
-
-#                        debug('Total errors: %d' % perror.total_errors)
-
-                        if perror.total_errors >= 5 and not perror.time_disabled:
-                            msg = '%s has been disabled for exceeding the maximum amount of errors.' % p.name.upper()
-                            msg += '\nThe last transfer errored with:\n\n%s' % stderr
-                            send_email(msg)
-                            perror.time_disabled = datetime.utcnow()
-                            perror.locking_agent = gethostname()
-                            updated_poller = self.session.query(Poller).filter(Poller.name == p.name).first()
-                            updated_poller.enabled = False
-                            info(msg)
+                        self.count_error(p.name, stderr)
 
                     self.process_list[poller].remove(p)
+                    p.release()
                     self.session.commit()
+                    self.session.expunge(res)
 
+                    # A finished transfer often means more is on the way
+                    self.pollermgr.wake(poller)
 
-class ExtendedPopen(subprocess.Popen):
-    """ Extended the subprocess.Popen so I could add some class vars without
-    duck punching it. """
-    def __init__(self, name, source, cmd):
-        self.name = name
-        self.source = source
-        super(ExtendedPopen, self).__init__(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+
+    def undelivered(self, name, asset):
+        """ Returns the files in a delivered asset's directory that were never sent, as
+        the poller's layout sees them, so the directory is not removed with them. """
+        matcher = None
+        for p in self.pollers:
+            if p.name == name:
+                matcher = layout(p.poller_type, self.rules.get(name), split_list(p.excludes))
+        if matcher:
+            names = matcher.files(asset.id)
+        else:
+            names = [f for f in os.listdir(asset.id) if os.path.isfile(os.path.join(asset.id, f))]
+        sent = asset.done | asset.markers
+        return sorted(f for f in names if os.path.join(asset.id, f) not in sent)
+
+    def count_error(self, name, error):
+        """ Counts a failed transfer against the poller in the error table, and disables
+        the poller once it has failed too often. """
+        perror = self.session.query(ErrorMgr).filter(ErrorMgr.name==name).first()
+        perror.total_errors += 1
+
+#        debug('Total errors: %d' % perror.total_errors)
+
+        if perror.total_errors >= 5 and not perror.time_disabled:
+            msg = '%s has been disabled for exceeding the maximum amount of errors.' % name.upper()
+            msg += '\nThe last transfer errored with:\n\n%s' % error
+            send_email(msg)
+            perror.time_disabled = datetime.utcnow()
+            perror.locking_agent = gethostname()
+            updated_poller = self.session.query(Poller).filter(Poller.name == name).first()
+            updated_poller.enabled = False
+            info(msg)
+
+    def stalled(self, p):
+        """ Returns why the transfer counts as stalled, or None if it does not. It has
+        stalled if ascp has printed nothing for STALL_TIMEOUT secs, or if it has been
+        running longer than its size takes at STALL_MIN_RATE KB/s, plus STALL_TIMEOUT. """
+        now = time.time()
+        if self.__stall_timeout and now - p.progress.updated >= self.__stall_timeout:
+            return 'No progress for %d secs, %d bytes sent' % (now - p.progress.updated, p.progress.bytes)
+        if self.__stall_min_rate and p.item.size:
+            budget = self.__stall_timeout + p.item.size / (self.__stall_min_rate * 1024.0)
+            if now - p.started > budget:
+                return 'Slower than %d KB/s, %d of %d bytes sent in %d secs' % (self.__stall_min_rate,
+                       p.progress.bytes, p.item.size, now - p.started)
+        return None
+
+    def poller_path(self, name, source):
+        """ Returns the path of the named poller, or the parent of source if the poller
+        is no longer known. """
+        for p in self.pollers:
+            if p.name == name:
+                return p.path
+        return os.path.dirname(source)
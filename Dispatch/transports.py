@@ -0,0 +1,310 @@
+# transports.py
+
+""" The ways a transfer can be carried out. A transport starts the transfer of a queued
+item and returns an object that behaves like the ascp process the TransferManager used to
+start itself: poll() and returncode, terminate(), read_output() feeding its progress,
+stderr to read the error from, release(), and the started and stalled attributes. """
+
+import errno
+import fcntl
+import logging
+import os
+import stat
+import subprocess
+import threading
+import time
+import Queue
+from StringIO import StringIO
+
+import packager
+from progress import Progress
+from rules import split_list
+
+debug = logging.getLogger('transports').debug
+warning = logging.getLogger('transports').warning
+
+# Poller hosts that mean the destination is a directory on this host
+LOCAL_HOSTS = ('local', 'file')
+
+# Added to a file's name while it is being copied
+PARTIAL_SUFFIX = '.partial'
+
+# How much a copy thread copies between checks for progress and termination
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# How much of an interrupted copy is copied again, it may not all have reached the disk
+RESUME_OVERLAP = 1024 * 1024
+
+def is_local(poller):
+    """ True if the poller's destination is on this host. """
+    return (poller.host or '').lower() in LOCAL_HOSTS
+
+def transfer_paths(poller, item):
+    """ Returns the path to send for item and the base it is sent relative to. A packaged
+    directory's tar is sent from the staging directory, so it lands where the directory
+    would have. """
+    if item.package:
+        return item.package, os.path.join(poller.path, packager.STAGING_DIR)
+    return item.source, poller.path
+
+class AsperaTransport(object):
+    """ Sends items with ascp, under the transfer supervisor when there is one. """
+
+    def __init__(self, ssh_keys, supervisor=None):
+        self.ssh_keys = ssh_keys
+        self.supervisor = supervisor
+        self.commands = {}
+
+    def start(self, poller, item, exclude=None):
+        argv, env, target = self.command(poller)
+        path, base = transfer_paths(poller, item)
+        argv = [a for a in argv if not a.startswith('--src-base=')] + ['--src-base=%s' % base, path, target]
+        if self.supervisor:
+            return self.supervisor.spawn(poller.name, item, argv, env)
+        return ExtendedPopen(poller.name, item, argv, env)
+
+    def command(self, poller):
+        """ Returns the ascp argv template, environment and remote target for the poller.
+        They are built once and only rebuilt when the poller's settings change. Secrets
+        are passed through the environment and no shell is involved, so paths never need
+        quoting. """
+
+        key = (poller.path, poller.host, poller.username, poller.password, poller.ssh_key,
+               poller.ssh_port, poller.transfer_speed, poller.destination, poller.encrypt,
+               poller.encrypt_passphrase, poller.excludes)
+        cached = self.commands.get(poller.name)
+        if cached and cached[0] == key:
+            return cached[1:]
+
+        debug('Building ascp command for %s' % poller.name)
+        env = dict(os.environ)
+        if poller.password:
+            env['ASPERA_SCP_PASS'] = str(poller.password)
+
+        if poller.encrypt:
+            env['ASPERA_SCP_FILEPASS'] = str(poller.encrypt_passphrase)
+
+        argv = ['/bin/ascp', '--ignore-host-key', '-k2', '-d', '-l', '%sM' % poller.transfer_speed,
+                '-m', '10K', '-TQ', '-P', str(int(poller.ssh_port))]
+
+        # The key is only written when it changes, not for every transfer
+        if poller.ssh_key:
+            key_name = os.path.join(self.ssh_keys, poller.name + '.pub')
+            with open(key_name, 'wb') as f:
+                f.write(poller.ssh_key)
+            os.chmod(key_name, 0600)
+            argv += ['-i', key_name]
+
+        if poller.encrypt:
+            argv.append('--file-crypt=encrypt')
+
+        # Excluded names are left out of directory transfers too
+        for pattern in split_list(poller.excludes):
+            argv += ['-E', pattern]
+
+        argv.append('--src-base=%s' % poller.path)
+
+        target = '%s@%s:/' % (poller.username, poller.host)
+        if poller.destination:
+            target += '%s/' % poller.destination
+
+        self.commands[poller.name] = (key, argv, env, target)
+        return argv, env, target
+
+class LocalTransport(object):
+    """ Copies items to a destination directory on this host, such as a local volume or
+    an NFS mount, without going through the network stack. The destination is laid out
+    as ascp would lay it out on a remote. """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+
+    def start(self, poller, item, exclude=None):
+        path, base = transfer_paths(poller, item)
+        dest_root = os.path.join('/', poller.destination or '')
+        return LocalCopy(poller.name, item, path, base, dest_root, exclude, self.workers)
+
+class ExtendedPopen(subprocess.Popen):
+    """ Extended the subprocess.Popen so I could add some class vars without
+    duck punching it. The command is executed directly, without a shell. """
+    def __init__(self, name, item, argv, env):
+        self.name = name
+        self.item = item
+        self.source = item.source
+        self.progress = Progress()
+        self.started = time.time()
+        self.stalled = None
+        super(ExtendedPopen, self).__init__(argv, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        # The output is drained as it arrives, so a chatty ascp never blocks on a full pipe
+        flags = fcntl.fcntl(self.stdout, fcntl.F_GETFL)
+        fcntl.fcntl(self.stdout, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def read_output(self):
+        """ Reads whatever ascp has printed since the last call. Returns how many more
+        bytes it reports sent. """
+        chunks = []
+        while True:
+            try:
+                data = os.read(self.stdout.fileno(), 65536)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not data:
+                break
+            chunks.append(data)
+        return self.progress.feed(''.join(chunks))
+
+    def release(self):
+        """ Closes the pipes once the transfer has been collected. """
+        self.stdout.close()
+        self.stderr.close()
+
+class LocalCopy(object):
+    """ Stands in for an ExtendedPopen for a copy the agent makes itself. The files are
+    copied by a pool of threads, with copy_file_range where the kernel can, each into a
+    .partial file that is renamed into place once complete, so the destination never
+    holds half a file. A copy that is interrupted picks up where its .partial stopped,
+    and files already in place are skipped. """
+
+    def __init__(self, name, item, path, base, dest_root, exclude=None, workers=4):
+        self.name = name
+        self.item = item
+        self.source = item.source
+        self.progress = Progress()
+        self.started = time.time()
+        self.stalled = None
+        self.returncode = None
+        self.stderr = StringIO()
+        self.copied = 0
+        self.errors = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+        t = threading.Thread(target=self.run, args=(path, base, dest_root, exclude, workers))
+        t.setDaemon(True)
+        t.start()
+
+    def run(self, path, base, dest_root, exclude, workers):
+        try:
+            files = Queue.Queue()
+            for f in self.plan(path, base, dest_root, exclude):
+                files.put(f)
+            threads = []
+            for i in range(max(1, min(workers, files.qsize()))):
+                t = threading.Thread(target=self.worker, args=(files,))
+                t.setDaemon(True)
+                t.start()
+                threads.append(t)
+            for t in threads:
+                t.join()
+        except (IOError, OSError), e:
+            self.errors.append(str(e))
+
+        # The error is in place before the copy is seen to be done
+        if self.errors:
+            self.stderr.write(self.errors[0])
+            self.stderr.seek(0)
+            self.returncode = 1
+        elif self.stopping.is_set():
+            self.stderr.write('Terminated')
+            self.stderr.seek(0)
+            self.returncode = -15
+        else:
+            self.returncode = 0
+
+    def plan(self, path, base, dest_root, exclude):
+        """ Creates the destination directories and returns the files to copy, as (source,
+        destination) pairs, largest first so no large file is left running alone at the
+        end. Names matching the exclude regex are left out. """
+
+        dest = os.path.join(dest_root, os.path.relpath(path, base))
+        if not os.path.isdir(path):
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            return [(path, dest)]
+
+        files = []
+        for root, dirs, names in os.walk(path):
+            if exclude:
+                dirs[:] = [d for d in dirs if not exclude.match(d)]
+                names = [n for n in names if not exclude.match(n)]
+            target = os.path.normpath(os.path.join(dest, os.path.relpath(root, path)))
+            if not os.path.isdir(target):
+                os.makedirs(target)
+            files.extend((os.path.join(root, n), os.path.join(target, n)) for n in names)
+        files.sort(key=lambda f: os.path.getsize(f[0]), reverse=True)
+        return files
+
+    def worker(self, files):
+        while not self.stopping.is_set():
+            try:
+                src, dest = files.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                self.copy_file(src, dest)
+            except (IOError, OSError), e:
+                self.errors.append('Unable to copy %s to %s: %s' % (src, dest, e))
+                self.stopping.set()
+
+    def copy_file(self, src, dest):
+        st = os.stat(src)
+        try:
+            done = os.stat(dest)
+            if done.st_size == st.st_size and int(done.st_mtime) == int(st.st_mtime):
+                return
+        except OSError:
+            pass
+
+        partial = dest + PARTIAL_SUFFIX
+        fd_out = os.open(partial, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            offset = max(0, min(os.fstat(fd_out).st_size, st.st_size) - RESUME_OVERLAP)
+            if offset:
+                debug('Resuming %s at %d bytes', partial, offset)
+            fd_in = os.open(src, os.O_RDONLY)
+            try:
+                os.lseek(fd_in, offset, os.SEEK_SET)
+                os.lseek(fd_out, offset, os.SEEK_SET)
+                remaining = st.st_size - offset
+                while remaining:
+                    if self.stopping.is_set():
+                        return
+                    count = min(remaining, CHUNK_SIZE)
+                    packager.copy(fd_in, fd_out, count)
+                    remaining -= count
+                    with self.lock:
+                        self.copied += count
+            finally:
+                os.close(fd_in)
+            os.ftruncate(fd_out, st.st_size)
+            os.fsync(fd_out)
+        finally:
+            os.close(fd_out)
+
+        os.chmod(partial, stat.S_IMODE(st.st_mode))
+        os.utime(partial, (st.st_atime, st.st_mtime))
+        os.rename(partial, dest)
+
+    def poll(self):
+        return self.returncode
+
+    def terminate(self):
+        """ Stops the copy, leaving the .partial files to resume from. """
+        self.stopping.set()
+
+    kill = terminate
+
+    def read_output(self):
+        """ Returns how many more bytes have been copied since the last call. """
+        with self.lock:
+            copied, self.copied = self.copied, 0
+        if copied:
+            self.progress.done += copied
+            self.progress.updated = time.time()
+        return copied
+
+    def release(self):
+        pass
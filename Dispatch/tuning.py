@@ -0,0 +1,111 @@
+# tuning.py
+
+import logging
+import time
+
+import metrics
+
+info = logging.getLogger('tuning').info
+debug = logging.getLogger('tuning').debug
+
+# Goodput changes smaller than this are treated as noise
+TOLERANCE = 0.1
+
+class HostStats(object):
+    __slots__ = ('limit', 'bytes', 'failures', 'goodput', 'since')
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.bytes = 0
+        self.failures = 0
+        self.goodput = None
+        self.since = time.time()
+
+class ConcurrencyController(object):
+    """ Tunes how many transfers run at once to each destination host, AIMD style.
+    Progress from running transfers and the bytes of completed ones add up to a goodput
+    figure per host, which is checked every interval. While a host is using its whole
+    limit and goodput holds up, the limit grows by one. If goodput drops, the limit is
+    cut to three quarters, and if transfers to the host failed it is halved. The limit
+    stays between min_limit and the sum of max_transfers of the pollers sending there. """
+
+    def __init__(self, interval=60, min_limit=1):
+        self.interval = interval
+        self.min_limit = min_limit
+        self.hosts = {}
+        self.evaluated = time.time()
+
+    def bounds(self, pollers):
+        """ Returns the (min, max) concurrency for each host. """
+        ceilings = {}
+        for p in pollers:
+            ceilings[p.host] = ceilings.get(p.host, 0) + p.max_transfers
+        return dict((host, (min(self.min_limit, ceiling), ceiling)) for host, ceiling in ceilings.iteritems())
+
+    def stats(self, host, ceiling):
+        if host not in self.hosts:
+            self.hosts[host] = HostStats(ceiling)
+        return self.hosts[host]
+
+    def limits(self, pollers):
+        """ Returns the current concurrency limit for each host. """
+        limits = {}
+        for host, (low, high) in self.bounds(pollers).iteritems():
+            stats = self.stats(host, high)
+            stats.limit = max(low, min(stats.limit, high))
+            limits[host] = stats.limit
+        return limits
+
+    def record(self, host, nbytes):
+        """ Adds bytes sent to host, from progress or a completed transfer. """
+        if nbytes > 0 and host in self.hosts:
+            self.hosts[host].bytes += nbytes
+
+    def failure(self, host):
+        if host in self.hosts:
+            self.hosts[host].failures += 1
+
+    def evaluate(self, pollers, transfer_queue, process_list):
+        """ Adjusts the limits once per interval. """
+        if time.time() - self.evaluated < self.interval:
+            return
+        self.evaluated = time.time()
+
+        active, queued = {}, {}
+        for p in pollers:
+            active[p.host] = active.get(p.host, 0) + len(process_list.get(p.name, []))
+            queued[p.host] = queued.get(p.host, 0) + len(transfer_queue.get(p.name, []))
+
+        for host, (low, high) in self.bounds(pollers).iteritems():
+            stats = self.stats(host, high)
+            elapsed = max(time.time() - stats.since, 1)
+            goodput = stats.bytes / elapsed
+            saturated = active.get(host, 0) >= stats.limit and queued.get(host, 0) > 0
+            limit = stats.limit
+
+            if stats.failures:
+                limit, reason = max(low, limit // 2), '%d failed transfers' % stats.failures
+            elif not saturated:
+                limit, reason = limit, None
+            elif stats.goodput is not None and goodput < stats.goodput * (1 - TOLERANCE):
+                limit, reason = max(low, limit * 3 // 4), 'goodput dropped'
+            else:
+                limit, reason = min(high, limit + 1), 'goodput held'
+
+            if limit != stats.limit:
+                info('Concurrency for %s: %d -> %d, %s (%.1f MB/s, was %s)' % (host, stats.limit, limit, reason,
+                     goodput / (1 << 20), '%.1f MB/s' % (stats.goodput / (1 << 20)) if stats.goodput is not None else 'unknown'))
+                metrics.incr('tuning.%s.changes' % host)
+            else:
+                debug('Concurrency for %s stays at %d (%.1f MB/s)' % (host, limit, goodput / (1 << 20)))
+
+            # Goodput is only comparable between intervals where the host was saturated
+            if saturated:
+                stats.goodput = goodput
+            stats.limit = limit
+            stats.bytes = 0
+            stats.failures = 0
+            stats.since = time.time()
+
+            metrics.gauge('tuning.%s.limit' % host, limit)
+            metrics.gauge('tuning.%s.goodput' % host, int(goodput))
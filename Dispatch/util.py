@@ -1,46 +1,169 @@
 import logging
 import os
+import resource
 import smtplib
 import sys
 import threading
+import time
+import Queue
 
 from ConfigParser import SafeConfigParser
 
+import metrics
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_DATEFMT = '%m/%d/%Y %I:%M:%S %p'
+
 def die(msg, ex=None):
     print msg
     if ex: print ex
     sys.exit(1)
 
 def setup_logging(settings, enable_debug, daemon):
+    """ Sends the log to the daemon log or the console through a QueueHandler, so the
+    threads logging never wait on the output. """
     debug = logging.getLogger('util').debug
     info = logging.getLogger('util').info
     if daemon:
         daemon_log = settings['DAEMON_LOG']
         if daemon_log:
-            fh = logging.FileHandler(daemon_log, 'a')
-            fh.setLevel(logging.DEBUG)
-            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
-            fh.setFormatter(formatter)
-            logging.getLogger().addHandler(fh)
-            if enable_debug:
-                logging.getLogger().setLevel(logging.DEBUG)
-            else:
-                logging.getLogger().setLevel(logging.INFO)
-
+            handler = logging.FileHandler(daemon_log, 'a')
+        else:
+            handler = None
     else:
-        logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', datefmt='%m/%d/%Y %I:%M:%S %p')
+        handler = logging.StreamHandler()
 
+    if handler:
+        handler.setLevel(logging.DEBUG)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=LOG_DATEFMT))
+        qh = QueueHandler([handler])
+        qh.addFilter(RateLimitFilter(settings['LOG_RATE_LIMIT']))
+        logging.getLogger().addHandler(qh)
         if enable_debug:
             logging.getLogger().setLevel(logging.DEBUG)
         else:
             logging.getLogger().setLevel(logging.INFO)
 
     debug("Debug Mode Enabled")
-    for k,v in settings.iteritems():
-        debug("%s:\t%s" % (k,v))
+    # One record, the rate limit would cut a setting per line short
+    debug("Settings:\n%s", '\n'.join("%s:\t%s" % (k,v) for k,v in settings.iteritems()))
 
     debug('Logging started successfully')
 
+def flush_logging():
+    """ Waits for the queued log records to be written. Called before forking, as a
+    parent that exits straight after the fork would lose them. """
+    for h in logging.getLogger().handlers:
+        h.flush()
+
+class QueueHandler(logging.Handler):
+    """ Puts records on a queue for a background thread to write to handlers, so the
+    threads logging only ever wait for the queue. Messages are formatted by the writer.
+    If the queue is full the record is dropped and counted rather than blocking.
+
+    The writer is started by the first record in a process, so a forked child starts
+    its own. """
+
+    def __init__(self, handlers, size=10000):
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.size = size
+        self.queue = None
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # Locks held by threads the fork left behind would never be released
+            for h in self.handlers:
+                h.createLock()
+            self.queue = Queue.Queue(self.size)
+            t = threading.Thread(target=self.writer, args=(self.queue,))
+            t.setDaemon(True)
+            t.start()
+            self.pid = os.getpid()
+
+    def handle(self, record):
+        """ Filters and queues the record, without the handler lock. """
+        rv = self.filter(record)
+        if rv:
+            self.emit(record)
+        return rv
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+
+        # The traceback has to be formatted now, its frames are going away
+        if record.exc_info:
+            record.exc_text = logging._defaultFormatter.formatException(record.exc_info)
+            record.exc_info = None
+
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            metrics.incr('logging.dropped')
+
+    def writer(self, queue):
+        while True:
+            record = queue.get()
+            if not isinstance(record, logging.LogRecord):
+                record.set()
+                continue
+            for h in self.handlers:
+                if record.levelno >= h.level:
+                    h.handle(record)
+
+    def flush(self):
+        """ Waits, a few secs at most, for the queued records to be written. """
+        if self.pid != os.getpid():
+            return
+        written = threading.Event()
+        try:
+            self.queue.put(written, timeout=1)
+        except Queue.Full:
+            return
+        written.wait(5)
+        for h in self.handlers:
+            h.flush()
+
+    def close(self):
+        self.flush()
+        for h in self.handlers:
+            h.close()
+        logging.Handler.close(self)
+
+class RateLimitFilter(logging.Filter):
+    """ Lets at most limit debug messages from each call site through every interval
+    secs, so a message logged for every item of every scan can not flood the log. How
+    many were held back is added to the next one let through. 0 turns it off. """
+
+    def __init__(self, limit, interval=60):
+        logging.Filter.__init__(self)
+        self.limit = limit
+        self.interval = interval
+        self.sites = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.limit or record.levelno > logging.DEBUG:
+            return True
+
+        site = (record.pathname, record.lineno)
+        with self.lock:
+            start, count, held = self.sites.get(site, (record.created, 0, 0))
+            if record.created - start >= self.interval:
+                start, count = record.created, 0
+            if count >= self.limit:
+                self.sites[site] = (start, count, held + 1)
+                return False
+            self.sites[site] = (start, count + 1, 0)
+
+        if held:
+            record.msg = '%s (%d similar messages held back)' % (record.msg, held)
+        return True
+
 def read_config(config_file):
     settings = {}
 
@@ -64,13 +187,65 @@ def read_config(config_file):
     try:
         section = 'dispatch'
         settings['POLL_INTERVAL'] = int(parser.get(section, 'POLL_INTERVAL'))
+        settings['POLL_INTERVAL_MIN'] = get_option(parser, section, 'POLL_INTERVAL_MIN', min(30, settings['POLL_INTERVAL']), int)
+        settings['POLL_INTERVAL_MAX'] = get_option(parser, section, 'POLL_INTERVAL_MAX', settings['POLL_INTERVAL'] * 4, int)
         settings['LOCK_FILE'] = parser.get(section, 'LOCK_FILE')
         settings['DAEMON_LOG'] = parser.get(section, 'DAEMON_LOG')
+        settings['STATE_FILE'] = get_option(parser, section, 'STATE_FILE')
+        settings['SUPERVISOR_SOCKET'] = get_option(parser, section, 'SUPERVISOR_SOCKET')
+        settings['CLEANUP_WORKERS'] = get_option(parser, section, 'CLEANUP_WORKERS', 2, int)
+        settings['STATUS_FILE'] = get_option(parser, section, 'STATUS_FILE')
+        settings['RULES_FILE'] = get_option(parser, section, 'RULES_FILE')
+        settings['AUTOTUNE'] = get_option(parser, section, 'AUTOTUNE', 'no').lower() in ('1', 'yes', 'true', 'on')
+        settings['AUTOTUNE_INTERVAL'] = get_option(parser, section, 'AUTOTUNE_INTERVAL', 60, int)
+        settings['AUTOTUNE_MIN'] = get_option(parser, section, 'AUTOTUNE_MIN', 1, int)
+        settings['PROGRESSIVE_POLLERS'] = get_option(parser, section, 'PROGRESSIVE_POLLERS', '')
+        settings['LOG_RATE_LIMIT'] = get_option(parser, section, 'LOG_RATE_LIMIT', 20, int)
+        settings['POLLER_WORKERS'] = get_option(parser, section, 'POLLER_WORKERS', 0, int)
+        settings['STALL_TIMEOUT'] = get_option(parser, section, 'STALL_TIMEOUT', 1800, int)
+        settings['STALL_MIN_RATE'] = get_option(parser, section, 'STALL_MIN_RATE', 0, int)
+        settings['STALL_BACKOFF'] = get_option(parser, section, 'STALL_BACKOFF', 60, int)
+        settings['QUEUE_HIGH_WATER'] = get_option(parser, section, 'QUEUE_HIGH_WATER', 1000, int)
+        settings['QUEUE_LOW_WATER'] = get_option(parser, section, 'QUEUE_LOW_WATER', None, int)
+        settings['AGENT_HIGH_WATER'] = get_option(parser, section, 'AGENT_HIGH_WATER', 10000, int)
+        settings['AGENT_LOW_WATER'] = get_option(parser, section, 'AGENT_LOW_WATER', None, int)
+        settings['INTAKE_SOCKET'] = get_option(parser, section, 'INTAKE_SOCKET')
+        settings['STABILITY_CHECK'] = get_option(parser, section, 'STABILITY_CHECK', 'auto').lower()
+        settings['PACKAGE_POLLERS'] = get_option(parser, section, 'PACKAGE_POLLERS', '')
+        settings['LOCAL_COPY_WORKERS'] = get_option(parser, section, 'LOCAL_COPY_WORKERS', 4, int)
     except Exception, err:
         die('Error in the transfermanager section of the config file.', err)
 
+    # Optional: the agent-wide transfer cap and each poller's share of it
+    settings['MAX_TOTAL_TRANSFERS'] = 0
+    settings['POLLER_WEIGHTS'] = {}
+    settings['POLLER_MINIMUMS'] = {}
+    settings['POLLER_HIGH_WATER'] = {}
+    settings['POLLER_LOW_WATER'] = {}
+    if parser.has_section('scheduler'):
+        try:
+            section = 'scheduler'
+            settings['MAX_TOTAL_TRANSFERS'] = get_option(parser, section, 'MAX_TRANSFERS', 0, int)
+            for option, value in parser.items(section):
+                if option.endswith('.weight'):
+                    settings['POLLER_WEIGHTS'][option[:-len('.weight')]] = float(value)
+                elif option.endswith('.min'):
+                    settings['POLLER_MINIMUMS'][option[:-len('.min')]] = int(value)
+                elif option.endswith('.high_water'):
+                    settings['POLLER_HIGH_WATER'][option[:-len('.high_water')]] = int(value)
+                elif option.endswith('.low_water'):
+                    settings['POLLER_LOW_WATER'][option[:-len('.low_water')]] = int(value)
+        except Exception, err:
+            die('Error in the scheduler section of the config file.', err)
+
     return settings
 
+def get_option(parser, section, option, default=None, cast=str):
+    """ Returns an optional setting from the config file, or default if it is not set. """
+    if not parser.has_option(section, option):
+        return default
+    return cast(parser.get(section, option))
+
 def send_email(msg, to=None):
 
     if not to:
@@ -91,17 +266,65 @@ Subject: %s
     server.sendmail(from_address, to, message)
     server.quit()
 
-def getsize(path):
+def getsize(path, exclude=None):
+    """ Returns the size of a file or directory. Names matching the exclude regex are
+    skipped, and excluded directories are not walked. """
     if os.path.isfile(path):
         return os.path.getsize(path)
     else:
         total = 0
         for (path, dirs, files) in os.walk(path):
+            if exclude:
+                dirs[:] = [d for d in dirs if not exclude.match(d)]
             for f in files:
-#                total += os.path.getsize(f)
+                if exclude and exclude.match(f):
+                    continue
                 total += os.path.getsize(os.path.join(path, f))
         return total
 
+class PathChecker(object):
+    """ Checks whether paths exist without hanging on an unresponsive mount. Each path
+    is checked in its own thread, and a path whose last check never returned is not
+    checked again until it does. """
+
+    def __init__(self):
+        self.checking = {}
+
+    def existing(self, paths, timeout):
+        """ Returns those of paths that exist. A path that does not answer within
+        timeout secs is taken as missing. """
+        found = set()
+        started = []
+        for path in set(paths):
+            t = self.checking.get(path)
+            if t and t.is_alive():
+                continue
+            t = threading.Thread(target=self._check, args=(path, found))
+            t.setDaemon(True)
+            t.start()
+            self.checking[path] = t
+            started.append(t)
+
+        deadline = time.time() + timeout
+        for t in started:
+            t.join(max(0, deadline - time.time()))
+        return set(found)
+
+    def _check(self, path, found):
+        if os.path.exists(path):
+            found.add(path)
+
+def memory_usage():
+    """ Returns the resident set size of this process in bytes. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
 class StoppableThread(threading.Thread):
     """Thread class with a stop() method. The thread itself has to check
     regularly for the stopped() condition."""
@@ -0,0 +1,322 @@
+# workers.py
+
+""" Runs the pollers in worker processes, so scanning and stability checks are not
+limited to the one core the agent's own process can use. The pollers are shared out
+between the workers, and each worker runs a PollerManager for its share. What they find
+is sent to the TransferManager, which coordinates the transfers, over a queue; it tells
+the worker when a source has been dealt with so it can be found again. """
+
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import Queue
+
+import metrics
+from assets import AssetRegistry
+from pollers import PollerManager
+from records import QueueItem, TransferQueue
+
+info = logging.getLogger('workers').info
+debug = logging.getLogger('workers').debug
+warning = logging.getLogger('workers').warning
+
+# How long a worker that died waits before it is started again
+RESTART_DELAY = 10
+
+# How often a worker sends its gauges to the coordinator
+GAUGES_INTERVAL = 60
+
+# How often a worker tells the coordinator it is alive
+HEARTBEAT_INTERVAL = 5
+
+# A worker not heard from for this long is restarted
+HEARTBEAT_TIMEOUT = 60
+
+# A worker whose poller manager has been in one round of polls for this long is
+# restarted, a scan stuck on a hung mount never returns
+POLL_TIMEOUT = 900
+
+class PollerSpec(object):
+    """ What a worker needs to create a poller, without the database row. """
+
+    __slots__ = ('name', 'path', 'poller_type', 'excludes')
+
+    def __init__(self, poller):
+        self.name = poller.name
+        self.path = poller.path
+        self.poller_type = poller.poller_type
+        self.excludes = poller.excludes
+
+class Outbox(object):
+    """ Stands in for a poller's TransferQueue in a worker. Items are sent to the
+    coordinator, and their sources are kept until it releases them, so a source is not
+    submitted again while it is queued or being transferred. """
+
+    def __init__(self, name, channel, outstanding=()):
+        self.name = name
+        self.channel = channel
+        self.sources = set(outstanding)
+
+    def append(self, item):
+        if item.source in self.sources:
+            return False
+        self.sources.add(item.source)
+        self.channel.put(('submit', self.name, item.source, item.fingerprint, item.asset, item.package))
+        return True
+
+    def release(self, source):
+        self.sources.discard(source)
+
+    def waiting(self):
+        return 0
+
+    def __contains__(self, source):
+        return source in self.sources
+
+    def __len__(self):
+        return len(self.sources)
+
+class WorkerRegistry(AssetRegistry):
+    """ A worker's copy of the coordinator's assets. Changes made by the pollers are
+    applied here and forwarded, and the coordinator's completed transfers are replayed
+    on it. Creating markers and queueing later stages is left to the coordinator. """
+
+    create_markers = False
+
+    def __init__(self, channel):
+        super(WorkerRegistry, self).__init__()
+        self.channel = channel
+
+    def register(self, asset_id, poller, members, stages=(), markers=(), sealed=True):
+        if asset_id not in self:
+            self.channel.put(('register', asset_id, poller, list(members), [list(stage) for stage in stages],
+                              list(markers), sealed))
+        return super(WorkerRegistry, self).register(asset_id, poller, members, stages, markers, sealed)
+
+    def add(self, asset_id, source):
+        added = super(WorkerRegistry, self).add(asset_id, source)
+        if added:
+            self.channel.put(('add', asset_id, source))
+        return added
+
+    def seal(self, asset_id, stages, markers=()):
+        super(WorkerRegistry, self).seal(asset_id, stages, markers)
+        self.channel.put(('seal', asset_id, [list(stage) for stage in stages], list(markers)))
+        return []
+
+def run_worker(index, specs, inbox, outbox, poll_min, poll_max, rules, assets, progressive, watermarks,
+               agent_watermarks, detect_writers, package, outstanding):
+    """ The main loop of a worker process. """
+
+    # Shutting down is up to the coordinator
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    parent = os.getppid()
+
+    # The agent's other threads may have held these at the fork, they would never be released
+    metrics.reinit()
+    logging._lock = threading.RLock()
+
+    names = [s.name for s in specs]
+    transfer_queue = dict((name, Outbox(name, outbox, outstanding.get(name, ()))) for name in names)
+    process_list = dict((name, []) for name in names)
+    registry = WorkerRegistry(outbox)
+    registry.load(assets, names)
+
+    mgr = PollerManager(specs, transfer_queue, process_list, poll_min, poll_max, rules, registry, progressive,
+                        watermarks, agent_watermarks, detect_writers, package)
+    mgr.start()
+    info('Poller worker %d started for %s', index, ', '.join(names))
+
+    reported = time.time()
+    beat = 0
+    while os.getppid() == parent:
+        if not mgr.is_alive():
+            warning('Poller worker %d lost its poller manager, exiting', index)
+            sys.exit(1)
+
+        try:
+            msg = inbox.get(timeout=5)
+        except Queue.Empty:
+            msg = None
+
+        if msg and msg[0] == 'release':
+            name, source, asset = msg[1:]
+            transfer_queue[name].release(source)
+            if asset:
+                registry.completed(QueueItem(source, asset=asset))
+        elif msg and msg[0] == 'wake':
+            mgr.wake(msg[1])
+        elif msg and msg[0] == 'stop':
+            mgr.stop()
+            mgr.join()
+            return
+
+        if time.time() - beat >= HEARTBEAT_INTERVAL:
+            beat = time.time()
+            busy_since = mgr.busy_since
+            outbox.put(('heartbeat', index, beat, beat - busy_since if busy_since else 0))
+
+        if time.time() - reported >= GAUGES_INTERVAL:
+            reported = time.time()
+            outbox.put(('gauges', metrics.snapshot()['gauges']))
+
+class WorkerPool(object):
+    """ Stands in for the PollerManager when the pollers run in worker processes. The
+    pollers are dealt round the workers by name. pump() applies what the workers have
+    sent and starts any worker that died again. A worker that stops sending heartbeats,
+    or whose polls stop making progress, is terminated and restarted the same way. The
+    agent's watermarks apply to each worker's share of the pollers. """
+
+    def __init__(self, count, pollers, transfer_queue, process_list, poll_min, poll_max, rules, assets,
+                 progressive=(), watermarks=None, agent_watermarks=None, detect_writers=False, package=()):
+        specs = sorted((PollerSpec(p) for p in pollers), key=lambda s: s.name)
+        count = max(1, min(count, len(specs)))
+        self.shards = [specs[i::count] for i in range(count)]
+        self.owner = dict((s.name, i) for i, shard in enumerate(self.shards) for s in shard)
+        self.transfer_queue = transfer_queue
+        self.process_list = process_list
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.rules = rules
+        self.assets = assets
+        self.progressive = progressive
+        self.watermarks = watermarks
+        self.agent_watermarks = agent_watermarks
+        self.detect_writers = detect_writers
+        self.package = package
+        self.outbox = multiprocessing.Queue()
+        self.inboxes = [None] * count
+        self.workers = [None] * count
+        self.died = [None] * count
+        self.heard = [0] * count
+        self.busy = [0] * count
+        self.hung = [False] * count
+
+        for s in specs:
+            transfer_queue.setdefault(s.name, TransferQueue())
+            process_list.setdefault(s.name, [])
+
+    def start(self):
+        for i in range(len(self.shards)):
+            self.spawn(i)
+
+    def spawn(self, index):
+        """ Starts a worker with what is currently queued or transferring for its pollers,
+        and the assets being delivered for them. """
+
+        names = set(s.name for s in self.shards[index])
+        outstanding = {}
+        for name in names:
+            sources = [item.source for item in self.transfer_queue[name].snapshot()]
+            sources += [p.source for p in self.process_list.get(name, [])]
+            outstanding[name] = sources
+        assets = dict((k, v) for k, v in self.assets.to_dict().iteritems() if v['poller'] in names)
+
+        inbox = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run_worker, name='poller-worker-%d' % index,
+                                       args=(index, self.shards[index], inbox, self.outbox, self.poll_min,
+                                             self.poll_max, self.rules, assets, self.progressive, self.watermarks,
+                                             self.agent_watermarks, self.detect_writers, self.package,
+                                             outstanding))
+        proc.daemon = True
+        proc.start()
+        self.inboxes[index] = inbox
+        self.workers[index] = proc
+        self.died[index] = None
+        self.heard[index] = time.time()
+        self.busy[index] = 0
+        self.hung[index] = False
+        debug('Started poller worker %d, pid %d', index, proc.pid)
+
+    def pump(self):
+        """ Applies everything the workers have sent, terminates the workers that have
+        stopped responding, and restarts the workers that died once they have been down
+        for RESTART_DELAY secs. """
+
+        while True:
+            try:
+                msg = self.outbox.get_nowait()
+            except Queue.Empty:
+                break
+            self.handle(msg)
+
+        for i, proc in enumerate(self.workers):
+            if proc.is_alive():
+                silent = time.time() - self.heard[i]
+                if not self.hung[i] and (silent >= HEARTBEAT_TIMEOUT or self.busy[i] >= POLL_TIMEOUT):
+                    warning('Poller worker %d for %s is not responding, silent for %d secs and polling for %d, '
+                            'terminating it', i, ', '.join(s.name for s in self.shards[i]), silent, self.busy[i])
+                    metrics.incr('workers.hung')
+                    self.hung[i] = True
+                    proc.terminate()
+                continue
+            if self.died[i] is None:
+                warning('Poller worker %d for %s exited with %s, restarting it in %d secs', i,
+                        ', '.join(s.name for s in self.shards[i]), proc.exitcode, RESTART_DELAY)
+                metrics.incr('workers.restarts')
+                self.inboxes[i].cancel_join_thread()
+                self.died[i] = time.time()
+            elif time.time() - self.died[i] >= RESTART_DELAY:
+                self.spawn(i)
+
+    def handle(self, msg):
+        op = msg[0]
+        if op == 'submit':
+            name, source, fp, asset, package = msg[1:]
+            queue = self.transfer_queue.get(name)
+            running = [p for p in self.process_list.get(name, []) if p.source == source]
+            if queue is None:
+                self.release(name, source)
+            elif not running:
+                # The intake may have queued it already, its transfer releases it when done
+                queue.append(QueueItem(source, fp, asset=asset, package=package))
+        elif op == 'register':
+            self.assets.register(*msg[1:])
+        elif op == 'add':
+            self.assets.add(*msg[1:])
+        elif op == 'seal':
+            asset = self.assets.get(msg[1])
+            items = self.assets.seal(*msg[1:])
+            if asset and asset.poller in self.transfer_queue:
+                for item in items:
+                    self.transfer_queue[asset.poller].append(item)
+        elif op == 'heartbeat':
+            index, sent, busy = msg[1:]
+            self.heard[index] = max(self.heard[index], sent)
+            self.busy[index] = busy
+        elif op == 'gauges':
+            for name, value in msg[1].iteritems():
+                metrics.gauge(name, value)
+
+    def send(self, name, msg):
+        index = self.owner.get(name)
+        if index is not None and self.workers[index].is_alive():
+            self.inboxes[index].put(msg)
+
+    def release(self, name, source, asset=None):
+        """ Tells the poller's worker that source has been dealt with. asset is given
+        when the transfer completed an asset member. """
+        self.send(name, ('release', name, source, asset))
+
+    def wake(self, name=None):
+        for s in self.owner:
+            if name is None or s == name:
+                self.send(s, ('wake', s))
+
+    def stop(self):
+        for i, proc in enumerate(self.workers):
+            if proc.is_alive():
+                self.inboxes[i].put(('stop',))
+
+    def join(self, timeout=10):
+        for proc in self.workers:
+            proc.join(timeout)
+            if proc.is_alive():
+                warning('Poller worker %s did not stop, terminating it', proc.name)
+                proc.terminate()
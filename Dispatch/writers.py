@@ -0,0 +1,153 @@
+# writers.py
+
+""" Tells whether a local process has a file open for writing, so the stability check does
+not have to wait to see whether the file changes. Open files are found through
+/proc/<pid>/fd, indexed by inode, and /proc/<pid>/fdinfo says how each was opened.
+Writers on other hosts can not be seen this way, so sources on network filesystems are
+left to the timed check. """
+
+import errno
+import logging
+import os
+import stat
+import threading
+import time
+
+debug = logging.getLogger('writers').debug
+
+# Filesystems other hosts can write to
+NETWORK_FS = frozenset(('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'ncpfs', 'afs', 'ceph', 'glusterfs', 'lustre',
+                        'gpfs', '9p', 'fuse.sshfs', 'fuse.glusterfs', 'fuse.s3fs'))
+
+# A file modified more recently than this may be between writes, so it is left for a later poll
+QUIET = 2
+
+# How often the mount table is read again
+MOUNTS_TTL = 60
+
+# The access mode bits of the open flags, os has no O_ACCMODE before Python 3
+O_ACCMODE = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+
+class WriterIndex(object):
+    """ An index of the regular files local processes have open, by (device, inode). It
+    is rebuilt at most every ttl secs, and whenever a file being checked has changed
+    since it was built. The index is shared by all the stability checks. """
+
+    def __init__(self, ttl=1.0, proc='/proc'):
+        self.ttl = ttl
+        self.proc = proc
+        self.lock = threading.Lock()
+        self.index = {}
+        self.complete = False
+        self.built = 0
+        self.mounts = []
+        self.mounts_read = 0
+
+    def refresh(self, changed=0):
+        """ Rebuilds the index if it is older than ttl secs or than changed. """
+        with self.lock:
+            if self.built > changed and time.time() - self.built < self.ttl:
+                return
+
+            built = time.time()
+            index = {}
+            complete = True
+            me = str(os.getpid())
+            for pid in os.listdir(self.proc):
+                if not pid.isdigit() or pid == me:
+                    continue
+                fd_dir = os.path.join(self.proc, pid, 'fd')
+                try:
+                    fds = os.listdir(fd_dir)
+                except OSError, e:
+                    # Another user's process, its writers can not be seen
+                    if e.errno == errno.EACCES:
+                        complete = False
+                    continue
+                for fd in fds:
+                    try:
+                        st = os.stat(os.path.join(fd_dir, fd))
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        index.setdefault((st.st_dev, st.st_ino), []).append((pid, fd))
+
+            if not complete and self.complete:
+                debug('Some processes can not be inspected, using the timed stability check')
+            self.index, self.complete, self.built = index, complete, built
+
+    def writing(self, st):
+        """ True if a process has the file with this stat open for writing. """
+        for pid, fd in self.index.get((st.st_dev, st.st_ino), ()):
+            try:
+                with open(os.path.join(self.proc, pid, 'fdinfo', fd)) as f:
+                    for line in f:
+                        if line.startswith('flags:'):
+                            if int(line.split()[1], 8) & O_ACCMODE != os.O_RDONLY:
+                                return True
+                            break
+            except IOError, e:
+                # Closed since the index was built, or hidden from us
+                if e.errno != errno.ENOENT:
+                    return True
+        return False
+
+    def fstype(self, path):
+        """ Returns the type of the filesystem path is on. """
+        if time.time() - self.mounts_read >= MOUNTS_TTL:
+            mounts = []
+            try:
+                with open(os.path.join(self.proc, 'self', 'mounts')) as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) > 2:
+                            point = fields[1].decode('string_escape')
+                            mounts.append((point, fields[2]))
+            except IOError:
+                pass
+            mounts.sort(key=lambda m: len(m[0]), reverse=True)
+            self.mounts, self.mounts_read = mounts, time.time()
+
+        path = os.path.realpath(path)
+        for point, fstype in self.mounts:
+            if path == point or path.startswith(point.rstrip('/') + '/'):
+                return fstype
+        return None
+
+    def check(self, source, files):
+        """ Returns True if none of files, the files making up source, is open for
+        writing and they did not change while being checked, False if one of them is
+        being written or was only just modified, or None if it can not be told. """
+
+        if not files or self.fstype(source) in NETWORK_FS:
+            return None
+
+        try:
+            before = [os.stat(f) for f in files]
+        except OSError:
+            return False
+
+        # A file that was only just written may be between writes, it is checked again later
+        newest = max(st.st_mtime for st in before)
+        age = time.time() - newest
+        if age < 0:
+            # Modified in the future by a skewed clock or a copied timestamp, recency can not be told
+            return None
+        if age < QUIET:
+            return False
+
+        self.refresh(newest)
+        if not self.complete:
+            return None
+        for f, st in zip(files, before):
+            if self.writing(st):
+                debug('%s is open for writing', f)
+                return False
+
+        try:
+            after = [os.stat(f) for f in files]
+        except OSError:
+            return False
+        if [(st.st_size, st.st_mtime) for st in before] != [(st.st_size, st.st_mtime) for st in after]:
+            return False
+        return True
@@ -6,12 +6,14 @@ import getopt
 import logging
 import os
 import sys
+import time
 import traceback
 
+started = time.time()
+
 from Dispatch.lockfile import LockFile
 from Dispatch.version import VERSION
 from Dispatch.util import read_config, setup_logging
-from Dispatch.transfer_manager import TransferManager
 
 def usage():
     print "Usage:"
@@ -59,14 +61,21 @@ if __name__ == '__main__':
     if not os.path.exists(keys_dir):
         os.mkdir(keys_dir)
 
+    if not settings['STATE_FILE']:
+        settings['STATE_FILE'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dispatch.state')
+
     setup_logging(settings, enable_debug, daemon)
 
+    # Imported late, the database libraries are not needed to print the usage or version,
+    # and before the lock is taken so a failed import does not leave it behind
+    from Dispatch.transfer_manager import TransferManager
+
     lock_file = LockFile(settings['LOCK_FILE'])
 
     lock_file.create()
 
     try:
-        tm = TransferManager(settings, lock_file, daemon)
+        tm = TransferManager(settings, lock_file, daemon, started)
     except Exception, e:
         traceback.print_exc(file=sys.stdout)
         print "\nTransferManager exited abnormally"
@@ -0,0 +1,54 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Dispatch.assets import AssetRegistry
+from Dispatch.records import QueueItem
+
+class StagedAssetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.member = os.path.join(self.dir, 'movie.mxf')
+        self.marker = os.path.join(self.dir, 'delivery.complete')
+        open(self.member, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_completed_moves_on_to_the_marker(self):
+        registry = AssetRegistry()
+        asset = registry.register(self.dir, 'google', [self.member], [[self.marker]], [self.marker])
+        self.assertEqual(asset.stage, 0)
+
+        items, finished = registry.completed(QueueItem(self.member, asset=self.dir))
+        self.assertEqual([i.source for i in items], [self.marker])
+        self.assertTrue(os.path.exists(self.marker))
+        self.assertEqual(finished, None)
+        self.assertEqual(asset.stage, 1)
+
+        items, finished = registry.completed(QueueItem(self.marker, asset=self.dir))
+        self.assertEqual(items, [])
+        self.assertTrue(finished is asset)
+        self.assertFalse(self.dir in registry)
+
+    def test_reloaded_asset_keeps_its_stage(self):
+        registry = AssetRegistry()
+        registry.register(self.dir, 'google', [self.member], [[self.marker]], [self.marker])
+
+        restored = AssetRegistry()
+        restored.load(registry.to_dict(), ['google'])
+        self.assertEqual(restored.get(self.dir).stage, 0)
+        self.assertTrue(restored.add(self.dir, os.path.join(self.dir, 'extra.xml')))
+
+        items, finished = restored.completed(QueueItem(self.member, asset=self.dir))
+        self.assertEqual(items, [])
+        restored.completed(QueueItem(os.path.join(self.dir, 'extra.xml'), asset=self.dir))
+        self.assertEqual(restored.get(self.dir).stage, 1)
+
+if __name__ == '__main__':
+    unittest.main()